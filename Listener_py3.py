@@ -18,16 +18,28 @@
 # 14-06-29 sze   Use 0MQ PUB-SUB protocol instead of TCP Sockets
 # 17-02-16 sze   Added autoDropOldest parameter
 import ctypes
+import os
+import random
+import struct
 import threading
 import time
 import traceback
 from queue import Empty, Full, Queue
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+import numpy as np
 import zmq
 import StringPickler_py3 as StringPickler
 
 # ipadd = '10.100.4.20'
 
+# capture file: CAPTURE_MAGIC, then for every received frame FRAME_HEADER (receive time, length) and the frame
+CAPTURE_MAGIC = b"ZMQCAP01"
+FRAME_HEADER = struct.Struct("<dI")
+
+# ZMQ options the socketOptions of a Listener may set, by their zmq names
+SOCKET_OPTIONS = ["RCVHWM", "RCVBUF", "RECONNECT_IVL", "RECONNECT_IVL_MAX", "TCP_KEEPALIVE", "TCP_KEEPALIVE_IDLE",
+                  "TCP_KEEPALIVE_INTVL", "TCP_KEEPALIVE_CNT", "CONFLATE"]
+
 class Listener(threading.Thread):
     """ Listener object which allows access to broadcasts via ZMQ sockets """
     def __init__(self,
@@ -41,7 +53,15 @@ class Listener(threading.Thread):
                  retry: bool = False,
                  name: str = "Listener",
                  logFunc: Optional[Callable] = None,
-                 autoDropOldest: bool = False) -> None:
+                 autoDropOldest: bool = False,
+                 allowField: Optional[str] = None,
+                 allowValues: Optional[Iterable] = None,
+                 batchFilter: Optional[Callable] = None,
+                 autoStart: bool = True,
+                 captureFile: Optional[str] = None,
+                 socketOptions: Optional[Dict[str, int]] = None,
+                 reconnectDelay: float = 1.0,
+                 reconnectDelayMax: float = 30.0) -> None:
         """ Create a listener running in a new daemonic thread which subscribes to broadcasts at
         the specified "port". The broadcast consists of entries of type "elementType" (a subclass of
         ctypes.Structure)
@@ -76,6 +96,31 @@ class Listener(threading.Thread):
 
         The "autoDropOldest" parameter, if True, will cause the oldest data to be automatically removed from
         the queue if the queue is full when new data arrive, rather than raise an exception.
+
+        For ctypes broadcasts, "allowField" and "allowValues" drop every element whose field allowField is
+        not in allowValues (e.g. allowField="streamNum") before the streamFilter is called and anything is
+        queued. All complete elements received so far are viewed as one numpy array and tested with a
+        single boolean mask, so elements that are dropped cost no Python code at all.
+
+        "batchFilter", if given, replaces the per-element streamFilter: it is called once per received
+        block with a numpy structured array of the (allowed) elements, and its result, if not None, is
+        queued as one item.
+
+        With "autoStart" False the thread is not started (and nothing is received); bytes put in self.data
+        are decoded by calling _ProcessCtypesStream/_ProcessArbitraryObjectStream, as bench_listener.py does.
+
+        "captureFile", if given, is a file every received ZMQ frame is appended to, raw and with the time it
+        was received, before it is decoded. Feed it back through the same decode path with ReplayListener.
+
+        "socketOptions" sets ZMQ options of the SUB socket before it connects, by name (see SOCKET_OPTIONS), e.g.
+        {"RCVHWM": 0, "RCVBUF": 4194304, "RECONNECT_IVL": 100, "RECONNECT_IVL_MAX": 5000, "TCP_KEEPALIVE": 1}.
+        RCVHWM 0 queues any number of messages instead of dropping them once the high-water mark (1000 by
+        default) is reached during a burst. CONFLATE 1 keeps only the latest message: for displays only, it
+        drops data by design.
+
+        After a failed connection the listener waits reconnectDelay s, doubled after every further failure up to
+        reconnectDelayMax, each wait randomly shortened by up to half (jitter) so that many listeners do not
+        reconnect in step. The delay is reset once a frame is received.
         """
         threading.Thread.__init__(self, name=name)
         self._stopevent = threading.Event()
@@ -91,6 +136,13 @@ class Listener(threading.Thread):
         self.notify = notify  # type: Optional[Callable]
         self.retry = retry  # type: bool
         self.autoDropOldest = autoDropOldest  # type: bool
+        self.socketOptions = dict(socketOptions or {})  # type: Dict[str, int]
+        for option in self.socketOptions:
+            if option not in SOCKET_OPTIONS:
+                raise ValueError("unknown socket option %s, use one of %s" % (option, SOCKET_OPTIONS))
+        self.reconnectDelay = reconnectDelay  # type: float
+        self.reconnectDelayMax = reconnectDelayMax  # type: float
+        self.failures = 0  # type: int  # failed connections since the last frame received
 
         try:
             if StringPickler.ArbitraryObject in self.elementType.__mro__:
@@ -100,10 +152,36 @@ class Listener(threading.Thread):
         if not self.IsArbitraryObject:
             self.recordLength = ctypes.sizeof(self.elementType)
 
+        self.allowField = allowField  # type: Optional[str]
+        self.batchFilter = batchFilter  # type: Optional[Callable]
+        self.recordType = None  # type: Optional[np.dtype]
+        if allowField is not None or batchFilter is not None:
+            if self.IsArbitraryObject:
+                raise ValueError("allowField and batchFilter need a ctypes elementType")
+            self.recordType = np.dtype(self.elementType)
+            if allowField is not None:
+                self.allowSet = set(allowValues)
+                self.allowArray = np.array(sorted(self.allowSet), dtype=self.recordType[allowField])
+                self.allowTable = None  # type: Optional[np.ndarray]
+                if self.allowArray.dtype.kind in "iu" and len(self.allowArray) and \
+                        0 <= self.allowArray[0] and self.allowArray[-1] < 65536:
+                    # small integers (stream numbers): one table lookup per element instead of np.isin
+                    self.allowTable = np.zeros(int(self.allowArray[-1]) + 2, dtype=bool)
+                    self.allowTable[self.allowArray] = True
+
+        self.capture = None  # type: Optional[Any]
+        self.lastCaptureFlush = 0.0  # type: float
+        if captureFile is not None:
+            new = not os.path.exists(captureFile) or os.path.getsize(captureFile) == 0
+            self.capture = open(captureFile, "ab")
+            if new:
+                self.capture.write(CAPTURE_MAGIC)
+
         self.zmqContext = zmq.Context()  # type: zmq.Context
         self.socket = None  # type: Optional[zmq.socket]
         self.setDaemon(True)
-        self.start()
+        if autoStart:
+            self.start()
 
     def safeLog(self, msg: str, *args: Any, **kwargs: Any) -> None:
         try:
@@ -122,7 +200,11 @@ class Listener(threading.Thread):
             self.socket = None
         self.zmqContext.term()
         self.zmqContext = None
-        threading.Thread.join(self, timeout)
+        if self.ident is not None:  # started
+            threading.Thread.join(self, timeout)
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     def run(self) -> None:
         poller = None  # type: zmq.Poller
@@ -134,6 +216,8 @@ class Listener(threading.Thread):
                         self.socket = self.zmqContext.socket(zmq.SUB)
                         if self.socket is None:
                             raise RuntimeError
+                        for option, value in self.socketOptions.items():
+                            self.socket.setsockopt(getattr(zmq, option), value)
                         self.socket.connect("tcp://%s:%s" % (self.host, self.port))
                         self.socket.setsockopt(zmq.SUBSCRIBE, b"")
                         poller.register(self.socket, zmq.POLLIN)
@@ -144,7 +228,7 @@ class Listener(threading.Thread):
                             msg = "Attempt to connect port %d by %s failed." % (self.port, self.name)
                             self.safeLog(msg)
                             self.notify(msg)
-                        time.sleep(1.0)
+                        self._backoff()
                         if self.retry:
                             continue
                         else:
@@ -153,12 +237,17 @@ class Listener(threading.Thread):
                 try:
                     socks = dict(poller.poll(timeout=1000))  # type: Dict[zmq.socket, Any]
                     if socks.get(self.socket) == zmq.POLLIN:
-                        self.data += self.socket.recv()
+                        frame = self.socket.recv()  # type: bytes
+                        self.failures = 0
+                        if self.capture is not None:
+                            self._capture(frame)
+                        self.data += frame
                 except Exception as e:  # Error accessing or reading from socket
                     self.safeLog("Error accessing or reading from port %d by %s. Error: %s." % (self.port, self.name, e))
                     if self.socket is not None:
                         self.socket.close()
                         self.socket = None
+                    self._backoff()
                     continue
                 # All received bytes are now appended to self.data
                 if self.IsArbitraryObject:
@@ -174,6 +263,7 @@ class Listener(threading.Thread):
                 if self.retry:
                     if self.notify is not None:
                         self.notify(e)
+                    # a decode or queue error, not a connection failure: reconnect at once, see _backoff
                     continue
                 else:
                     if self.notify is not None:
@@ -182,22 +272,20 @@ class Listener(threading.Thread):
                     else:
                         raise
 
+    def _backoff(self) -> None:
+        """ Wait before connecting again after a connect or receive failure: exponential backoff with jitter,
+        ended early by stop(). Errors while processing received data reconnect at once, so less is missed. """
+        delay = min(self.reconnectDelayMax, self.reconnectDelay * 2 ** min(self.failures, 30))  # type: float
+        self.failures += 1
+        self._stopevent.wait(random.uniform(delay / 2, delay))
+
     def _ProcessArbitraryObjectStream(self) -> None:
         while 1:
             try:
                 obj, residual = StringPickler.unpack_arbitrary_object(self.data)  # type: Any, bytes
                 if self.streamFilter is not None:
                     obj = self.streamFilter(obj)
-                if obj is not None and self.queue is not None:
-                    while True:
-                        try:
-                            self.queue.put_nowait(obj)
-                            break
-                        except Full:
-                            if self.autoDropOldest:
-                                self.queue.get_nowait()
-                            else:
-                                raise
+                self._enqueue(obj)
                 self.data = residual
             except StringPickler.IncompletePacket:
                 # All objects have been stripped out.  Get out of the loop to
@@ -210,25 +298,142 @@ class Listener(threading.Thread):
             except StringPickler.InvalidHeader:
                 raise
 
+    def _capture(self, frame: bytes) -> None:
+        now = time.time()
+        self.capture.write(FRAME_HEADER.pack(now, len(frame)))
+        self.capture.write(frame)
+        if now - self.lastCaptureFlush > 1.0:
+            self.capture.flush()
+            self.lastCaptureFlush = now
+
+    def _enqueue(self, obj: Any) -> None:
+        if obj is not None and self.queue is not None:
+            while True:
+                try:
+                    self.queue.put_nowait(obj)
+                    break
+                except Full:
+                    if self.autoDropOldest:
+                        self.queue.get_nowait()
+                    else:
+                        raise
+
     def _ProcessCtypesStream(self) -> None:
+        if self.recordType is not None:
+            self._ProcessCtypesBatch()
+            return
         while len(self.data) >= self.recordLength:
             result = StringPickler.bytes_as_object(self.data[0:self.recordLength], self.elementType)  # type: Any
             if self.streamFilter is not None:
                 obj = self.streamFilter(result)  # type: Any
             else:
                 obj = result
-            if obj is not None and self.queue is not None:
-                while True:
-                    try:
-                        self.queue.put_nowait(obj)
-                        break
-                    except Full:
-                        if self.autoDropOldest:
-                            self.queue.get_nowait()
-                        else:
-                            raise
+            self._enqueue(obj)
             self.data = self.data[self.recordLength:]
 
+    def _ProcessCtypesBatch(self) -> None:
+        """ Process all complete elements in self.data at once, see allowField and batchFilter """
+        n = len(self.data) // self.recordLength  # type: int
+        if n == 0:
+            return
+        if n < 8 and self.batchFilter is None:
+            # a few elements (usually one per ZMQ frame): numpy costs more than it saves
+            for i in range(n):
+                result = self.elementType.from_buffer_copy(self.data, i * self.recordLength)  # type: Any
+                if getattr(result, self.allowField) in self.allowSet:
+                    if self.streamFilter is not None:
+                        result = self.streamFilter(result)
+                    self._enqueue(result)
+            self.data = self.data[n * self.recordLength:]
+            return
+        records = np.frombuffer(self.data, dtype=self.recordType, count=n)  # type: np.ndarray
+        if self.allowField is None:
+            keep = range(n)  # type: Any
+        elif self.allowTable is not None:
+            values = records[self.allowField].astype(np.int64)
+            values[(values < 0) | (values >= len(self.allowTable))] = len(self.allowTable) - 1  # not allowed
+            keep = np.flatnonzero(self.allowTable[values])
+        else:
+            keep = np.flatnonzero(np.isin(records[self.allowField], self.allowArray))
+        if self.batchFilter is not None:
+            if len(keep):
+                self._enqueue(self.batchFilter(records[keep]))
+        else:
+            for i in keep:
+                result = self.elementType.from_buffer_copy(self.data, i * self.recordLength)  # type: Any
+                if self.streamFilter is not None:
+                    result = self.streamFilter(result)
+                self._enqueue(result)
+        self.data = self.data[n * self.recordLength:]
+
+
+
+def read_capture(path: str) -> Any:
+    """ Yield (receive time, frame) for every frame of a capture file written by Listener. A frame cut short
+    at the end of the file (capture stopped by a crash) is skipped.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a Listener capture file" % path)
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            t, length = FRAME_HEADER.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield t, frame
+
+
+class ReplayListener(Listener):
+    """ Listener that reads the frames of a capture file instead of a ZMQ socket, and decodes them exactly as
+    a Listener would (same elementType, filters, allow set and queue).
+
+    "speed" is the replay speed: 1 keeps the original timing between frames, N is N times faster and 0 is as
+    fast as possible. Elements are queued with a blocking put, so a fast replay waits for the consumer instead
+    of dropping data. The thread ends after the last frame; "finished" is set then.
+    """
+    def __init__(self, queue: Optional[Queue], captureFile: str, elementType: Any, speed: float = 1.0,
+                 **kwargs: Any) -> None:
+        kwargs["autoStart"] = False
+        Listener.__init__(self, queue, "", 0, elementType, **kwargs)
+        self.captureFile = captureFile  # type: str
+        self.speed = speed  # type: float
+        self.finished = threading.Event()
+        self.start()
+
+    def run(self) -> None:
+        try:
+            t0 = None  # type: Optional[float]
+            start = time.time()  # type: float
+            for t, frame in read_capture(self.captureFile):
+                if self._stopevent.is_set():
+                    break
+                if self.speed:
+                    if t0 is None:
+                        t0 = t
+                    delay = (t - t0) / self.speed - (time.time() - start)  # type: float
+                    if delay > 0:
+                        time.sleep(delay)
+                self.data += frame
+                if self.IsArbitraryObject:
+                    self._ProcessArbitraryObjectStream()
+                else:
+                    self._ProcessCtypesStream()
+        except Exception as e:
+            self.safeLog("Replay of %s by %s failed." % (self.captureFile, self.name), verbose=traceback.format_exc())
+            if self.notify is not None:
+                self.notify(e)
+            else:
+                raise
+        finally:
+            self.finished.set()
+
+    def _enqueue(self, obj: Any) -> None:
+        if obj is not None and self.queue is not None:
+            self.queue.put(obj)
+
 #### below code does not run because Host function sits on analyzer and old python2 version conflict
 if __name__ == "__main__":
     import ctypes
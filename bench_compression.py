@@ -0,0 +1,103 @@
+# compare HDF5 compression settings for RDF files on real optical + sensor data
+# reports write time, read time and file size for every setting
+#
+# The files of every setting are written first and read back afterwards, after dropping them from the
+# page cache where the OS allows it (posix_fadvise), so read times are not those of a cached file.
+#
+# $ python bench_compression.py             # first 3 optical files, write to output_folder
+# $ python bench_compression.py -n 10 -o /tmp/bench
+
+import argparse
+import os
+import time
+
+from tables import open_file
+
+import merge
+from merge import build_spectrum_dict, fillRdfTables, match_sensor_files
+
+# (codec, level, shuffle); fletcher32 and chunking are taken from the command line
+SETTINGS = [
+    ("none", 0, False),
+    ("zlib", 1, True),
+    ("zlib", 5, True),
+    ("blosc:lz4", 1, True),
+    ("blosc:lz4", 5, True),
+    ("blosc:zstd", 1, True),
+    ("blosc:zstd", 5, True),
+    ("blosc:zstd", 9, True),
+]
+
+
+def read_all(path):
+    """read every table of an RDF file, as a downstream script would."""
+    with open_file(path, "r") as h:
+        for table in h.walk_nodes("/", "Table"):
+            table.read()
+
+
+def drop_cache(path):
+    """ask the OS to drop a file from the page cache (Linux, BSD); returns False where it cannot."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+if __name__ == "__main__":
+    merge.init_worker()
+    optical_folder_path = merge.optical_folder_path
+
+    parser = argparse.ArgumentParser(description="benchmark HDF5 compression settings for RDF output")
+    parser.add_argument("-n", type=int, default=3, help="number of optical files to use")
+    parser.add_argument("-o", "--out", default=merge.output_folder,
+                        help="folder to write test files to, default output_folder (the network drive)")
+    parser.add_argument("--no-fletcher32", action="store_true", help="disable chunk checksums")
+    parser.add_argument("--chunkshape", type=int, default=0, help="rows per HDF5 chunk (0: PyTables)")
+    parser.add_argument("--expectedrows", type=int, default=0, help="expected rows per table (0: PyTables)")
+    args = parser.parse_args()
+
+    optical_file_list, matchDict = match_sensor_files(optical_folder_path, merge.sensor_folder_path)
+    ops = [op for op in optical_file_list if matchDict[op]][:args.n]
+    if not ops:
+        raise SystemExit("no optical file with sensor data found")
+
+    print("* building spectra for %s optical files" % len(ops))
+    spectra = [build_spectrum_dict(os.path.join(optical_folder_path, op + ".csv"), matchDict[op], None)
+               for op in ops]
+
+    # 1. write the files of every setting
+    print("* writing %s settings" % len(SETTINGS))
+    results = []
+    for i, (codec, level, shuffle) in enumerate(SETTINGS):
+        compression = dict(codec=codec, level=level, shuffle=shuffle,
+                           fletcher32=not args.no_fletcher32,
+                           expectedrows=args.expectedrows, chunkshape=args.chunkshape)
+        paths = [os.path.join(args.out, "_bench_%s_%s.h5" % (i, op)) for op in ops]
+
+        t0 = time.time()
+        for path, spectrumDict in zip(paths, spectra):
+            fillRdfTables(path, spectrumDict, compression=compression)
+        t_write = time.time() - t0
+        results.append((paths, t_write, sum(os.path.getsize(path) for path in paths)))
+
+    # 2. read them back, once the last writes no longer sit in the page cache
+    dropped = all([drop_cache(path) for paths, t_write, size in results for path in paths])
+    if not dropped:
+        print("! cannot drop files from the page cache here: read times may be those of cached files")
+
+    print("%-12s %5s %7s %10s %10s %12s" % ("codec", "level", "shuffle", "write (s)", "read (s)", "size (MB)"))
+    for (codec, level, shuffle), (paths, t_write, size) in zip(SETTINGS, results):
+        t0 = time.time()
+        for path in paths:
+            read_all(path)
+        t_read = time.time() - t0
+
+        for path in paths:
+            os.remove(path)
+        print("%-12s %5d %7s %10.2f %10.2f %12.2f" % (codec, level, shuffle, t_write, t_read, size / 1e6))
@@ -0,0 +1,156 @@
+# microbenchmarks of the Listener / StringPickler decode path, in-process with synthetic data
+# reports records/s and per-record latency percentiles for every case
+#
+# $ python bench_listener.py --save bench_listener.json      # record a baseline
+# $ python bench_listener.py --compare bench_listener.json   # exit 1 if a case got slower
+
+import argparse
+import json
+import platform
+import sys
+import time
+from queue import Queue
+
+import numpy as np
+
+import StringPickler_py3 as StringPickler
+from Listener_py3 import Listener
+from stream import SensorEntryType, sensorNumberDict
+
+STREAM_NUMS = [k for k in sensorNumberDict if k != 'timestamp']
+FRAME_RECORDS = [1, 16, 256]  # sensor records per ZMQ frame
+PACKET_FLOATS = [10, 1000, 100000]  # size of the arbitrary object packets
+
+
+def sensor_bytes(n, all_streams=False):
+    """n SensorEntryType records as broadcast; all_streams adds as many streams we do not record."""
+    nums = STREAM_NUMS + [100 + i for i in range(len(STREAM_NUMS))] if all_streams else STREAM_NUMS
+    return b"".join(StringPickler.object_as_bytes(SensorEntryType(63870000000000 + 200 * i, nums[i % len(nums)], i))
+                    for i in range(n))
+
+
+def packet(n_floats):
+    return StringPickler.pack_arbitrary_object({"timestamp": 63870000000000, "values": [0.5] * n_floats})
+
+
+def stats(times_ns, records):
+    """result of a case from the duration of each timed call and the records it handled."""
+    per_record = np.asarray(times_ns, dtype=float) / records / 1000.0  # us
+    return {
+        "records_per_s": round(1e6 / per_record.mean(), 1),
+        "p50_us": round(float(np.percentile(per_record, 50)), 3),
+        "p90_us": round(float(np.percentile(per_record, 90)), 3),
+        "p99_us": round(float(np.percentile(per_record, 99)), 3),
+    }
+
+
+def bench_bytes_as_object(n):
+    data = sensor_bytes(1)
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter_ns()
+        StringPickler.bytes_as_object(data, SensorEntryType)
+        times.append(time.perf_counter_ns() - t0)
+    return stats(times, 1)
+
+
+def bench_unpack(n, n_floats):
+    data = packet(n_floats)
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter_ns()
+        StringPickler.unpack_arbitrary_object(data)
+        times.append(time.perf_counter_ns() - t0)
+    return stats(times, 1)
+
+
+def bench_ctypes_stream(n, frame_records, **listener_args):
+    """feed frames to _ProcessCtypesStream as the receiving thread would; the queue is emptied between frames."""
+    q = Queue(0)
+    listener = Listener(q, "localhost", 0, SensorEntryType, autoStart=False, **listener_args)
+    frame = sensor_bytes(frame_records, all_streams="allowField" in listener_args)
+    times = []
+    for _ in range(max(1, n // frame_records)):
+        listener.data += frame
+        t0 = time.perf_counter_ns()
+        listener._ProcessCtypesStream()
+        times.append(time.perf_counter_ns() - t0)
+        while not q.empty():
+            q.get_nowait()
+    listener.stop()
+    return stats(times, frame_records)
+
+
+def bench_arbitrary_stream(n, n_floats):
+    q = Queue(0)
+    listener = Listener(q, "localhost", 0, StringPickler.ArbitraryObject, autoStart=False)
+    data = packet(n_floats)
+    times = []
+    for _ in range(n):
+        listener.data += data
+        t0 = time.perf_counter_ns()
+        listener._ProcessArbitraryObjectStream()
+        times.append(time.perf_counter_ns() - t0)
+        q.get_nowait()
+    listener.stop()
+    return stats(times, 1)
+
+
+def run(n):
+    results = {"bytes_as_object": bench_bytes_as_object(n)}
+    for size in PACKET_FLOATS:
+        count = max(10, n // max(1, size // 100))
+        results["unpack_arbitrary_object/%s" % size] = bench_unpack(count, size)
+    for frame_records in FRAME_RECORDS:
+        results["ctypes_stream/%s" % frame_records] = bench_ctypes_stream(n, frame_records)
+        # half of the records are streams we do not record, dropped by the allow set of stream.py
+        results["ctypes_stream_allow/%s" % frame_records] = bench_ctypes_stream(
+            n, frame_records, allowField="streamNum", allowValues=STREAM_NUMS)
+    for size in PACKET_FLOATS:
+        count = max(10, n // max(1, size // 100))
+        results["arbitrary_stream/%s" % size] = bench_arbitrary_stream(count, size)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """cases that are slower than the baseline by more than tolerance (fraction), as printable lines."""
+    slower = []
+    for case, base in baseline["results"].items():
+        if case not in results:
+            continue
+        r = results[case]
+        if r["records_per_s"] < base["records_per_s"] * (1 - tolerance):
+            slower.append("%s: %.0f records/s, baseline %.0f" % (case, r["records_per_s"], base["records_per_s"]))
+        elif r["p50_us"] > base["p50_us"] * (1 + tolerance):
+            slower.append("%s: p50 %.3f us, baseline %.3f us" % (case, r["p50_us"], base["p50_us"]))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the Listener and StringPickler decode path")
+    parser.add_argument("-n", type=int, default=20000, help="records per case")
+    parser.add_argument("--save", metavar="JSON", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="baseline to compare with, exit 1 if slower")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slow down before a case fails the comparison (fraction)")
+    args = parser.parse_args()
+
+    results = run(args.n)
+    print("%-32s %12s %10s %10s %10s" % ("case", "records/s", "p50 (us)", "p90 (us)", "p99 (us)"))
+    for case, r in results.items():
+        print("%-32s %12.0f %10.3f %10.3f %10.3f" % (case, r["records_per_s"], r["p50_us"], r["p90_us"], r["p99_us"]))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.node(), "n": args.n,
+                       "results": results}, f, indent=1)
+        print("* baseline saved: %s" % args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.tolerance)
+        for line in slower:
+            print("! slower: " + line)
+        if slower:
+            sys.exit(1)
+        print("* no case slower than the baseline by more than %d%%" % (100 * args.tolerance))
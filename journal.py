@@ -0,0 +1,109 @@
+# write-ahead journal of the sensor values stream.py has received but not yet saved to csv
+#
+# Every value is appended as a fixed 16 byte record (time, column in utility.header, value) to a
+# local file. A background thread writes and fsyncs what was appended every commit_interval, so a
+# crash or power loss costs at most that much data instead of a whole save_interval. The journal is
+# truncated after every successful csv save (the local csv written with write_synced, so it is on disk
+# first) and replayed when stream.py starts again.
+
+import os
+import struct
+import threading
+
+RECORD = struct.Struct("<dIf")  # unix time, column, value (float32, as broadcast by the analyzer)
+
+
+class Journal(object):
+    """Append-only journal with group commit: one write and one fsync per commit_interval."""
+    def __init__(self, path, commit_interval=0.05):
+        """
+        Args:
+            path: journal file on a local disk, created if needed, appended to if it exists
+            commit_interval: s between fsyncs, the most data a crash can lose
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.f = open(path, "ab")
+        self.buffer = bytearray()
+        self.lock = threading.Lock()  # guards self.buffer
+        self.commit_lock = threading.Lock()  # one commit or truncate at a time
+        self._stopevent = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="journal commit", daemon=True)
+        self.thread.start()
+
+    def append(self, utime, column, value):
+        with self.lock:
+            self.buffer += RECORD.pack(utime, column, value)
+
+    def commit(self):
+        """write and fsync what was appended so far."""
+        with self.commit_lock:
+            with self.lock:
+                data = bytes(self.buffer)
+                self.buffer.clear()
+            if data:
+                self.f.write(data)
+                self.f.flush()
+                os.fsync(self.f.fileno())
+
+    def truncate(self):
+        """drop everything journaled so far, once it is saved elsewhere."""
+        with self.commit_lock:
+            with self.lock:
+                self.buffer.clear()
+            self.f.truncate(0)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def _run(self):
+        while not self._stopevent.wait(self.commit_interval):
+            try:
+                self.commit()
+            except OSError as e:
+                print("! journal commit failed: %s" % e)
+
+    def close(self):
+        self._stopevent.set()
+        self.thread.join()
+        self.commit()
+        self.f.close()
+
+
+def write_synced(path, write):
+    """write a file so that it survives a power loss before the journal is truncated: write(f) fills a
+    temporary file, which is fsynced, renamed to path, and the rename fsynced with its folder."""
+    temp = path + ".tmp"
+    with open(temp, "w", newline="") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+    if hasattr(os, "O_DIRECTORY"):  # a folder cannot be opened (nor needs to be synced) on Windows
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def replay(path):
+    """records of a journal file, [(utime, column, value), ...]; a record cut short by a crash is ignored."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        data = f.read()
+    n = len(data) // RECORD.size
+    return list(RECORD.iter_unpack(data[:n * RECORD.size]))
+
+
+def rows_from_records(records, n_columns):
+    """rebuild the sensor rows of stream.py ([utime, values in header order]) from journal records."""
+    rows = []
+    sensor = None
+    for utime, column, value in records:
+        if sensor is None or utime != sensor[0]:
+            sensor = [0] * n_columns
+            sensor[0] = utime
+            rows.append(sensor)
+        sensor[column] = value
+    return rows
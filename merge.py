@@ -3,124 +3,638 @@
 # using multiprocessing
 
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import pandas as pd
 import os
 from glob import glob
 import multiprocessing
+import queue
+import io
+import datetime
+from functools import lru_cache
 
 from tables import open_file, Filters
 from tables import Float32Col, Float64Col, Int16Col, Int32Col, Int64Col
 from tables import UInt16Col, UInt32Col, UInt64Col
 import traceback
+import shutil
+from collections import deque
 
 from utility import header, unixTimeToTimestamp, load_conf
+from utility import OPTICAL_TIME_OFFSET, load_sensor_index
 from utility import controlData_key, sensorData_key, rdData_key
+# with sparse columns, constant columns are stored as a one row table of the same name in this group
+from rdf_reader import CONSTANT_GROUP
+from work_claim import WorkDir, LeaseRenewer
+from staging import Uploader
+from sensor_store import SensorStore
+from parquet_export import export_parquet
 
 
-def fillRdfTables(fileName, spectrumDict, attrs=None):
+RDF_TABLES = ["rdData", "sensorData", "tagalongData", "controlData", "spectrumIndex"]
+
+# HDF5 compression of the RDF tables, overridden by rdf_compression in config.yaml
+DEFAULT_COMPRESSION = dict(
+    codec="zlib",  # zlib, blosc:lz4, blosc:zstd, none
+    level=1,
+    shuffle=True,
+    fletcher32=True,
+    expectedrows=0,  # 0: PyTables default
+    chunkshape=0,  # rows per HDF5 chunk, 0: chosen by PyTables
+)
+
+# Lookup table giving pyTables column generation function keyed
+# by the numpy dtype.name
+colByName = dict(
+    float32=Float32Col,
+    float64=Float64Col,
+    int16=Int16Col,
+    int32=Int32Col,
+    int64=Int64Col,
+    uint16=UInt16Col,
+    uint32=UInt32Col,
+    uint64=UInt64Col,
+)
+
+
+def rdf_filters(compression=None):
+    """build the PyTables Filters for a compression setting (see DEFAULT_COMPRESSION)."""
+    comp = dict(DEFAULT_COMPRESSION)
+    if compression:
+        comp.update(compression)
+    if comp["codec"] == "none":
+        return Filters(complevel=0, fletcher32=comp["fletcher32"])
+    return Filters(complevel=comp["level"], complib=comp["codec"],
+                   shuffle=comp["shuffle"], fletcher32=comp["fletcher32"])
+
+
+class RdfWriter(object):
+    """Incrementally append spectrumDict tables to an HDF5 output file.
+
+    Tables are created the first time they are appended to, with the column types taken from that
+    first block of data; later blocks are appended to the same tables. This lets a large optical
+    file be written a chunk at a time instead of holding all of it in memory.
+
+    With sparse=True, columns holding a single value (typically the template columns we have no
+    data for and fill with 0) are not written row by row: their value is stored once in a one row
+    table /constantColumns/<tableName> and the main table only holds the varying columns.
+
+    With group, the tables go into a new group of an already open file instead of its root, so
+    several optical files can share one h5 file (see write_consolidated).
+    """
+    def __init__(self, fileName, attrs=None, compression=None, sparse=False, group=None):
+        """
+        Args:
+            fileName: name of the HDF5 file to create, or an open tables.File when group is given
+            attrs: Dictionary of attributes to be written to the file (or group)
+            compression: Dictionary of HDF5 compression settings, see DEFAULT_COMPRESSION
+            sparse: store constant columns once instead of in every row
+            group: name of the group to write the tables to; an existing group of that name is replaced
+        """
+        self.hdf5Filters = rdf_filters(compression)
+        self.tableOptions = {}
+        if compression and compression.get("expectedrows"):
+            self.tableOptions["expectedrows"] = compression["expectedrows"]
+        if compression and compression.get("chunkshape"):
+            self.tableOptions["chunkshape"] = (compression["chunkshape"],)
+        if group is None:
+            self.hdf5Handle = open_file(fileName, "w")
+            self.where = self.hdf5Handle.root
+        else:
+            self.hdf5Handle = fileName
+            if group in self.hdf5Handle.root:
+                self.hdf5Handle.remove_node(self.hdf5Handle.root, group, recursive=True)
+            self.where = self.hdf5Handle.create_group(self.hdf5Handle.root, group)
+        self.ownHandle = group is None
+        if attrs is not None:
+            for a in attrs:
+                setattr(self.where._v_attrs, a, attrs[a])
+        self.sparse = sparse
+        self.tableDict = {}
+        self.constantDict = {}  # {tableName: {column name: value}}
+
+    def append(self, tableName, spectTableData, constant=None):
+        """Append a block of rows to tableName.
+
+        Args:
+            tableName: one of RDF_TABLES
+            spectTableData: dictionary whose keys are the column names and whose values are lists
+                or arrays of the column data, all of the same length; or a numpy structured array
+                (see build_rd_data), appended as it is when its fields are the columns of the table
+            constant: with sparse=True, the columns that may be stored as constants. Only used for
+                the first block of a table. If None, every column that is constant in the first
+                block is, which is only safe when the first block is the whole table.
+        """
+        names = _column_names(spectTableData)
+        if len(names) == 0:
+            return
+        if tableName not in self.tableDict and self.sparse:
+            self._writeConstants(tableName, spectTableData, constant)
+        constants = self.constantDict.get(tableName, {})
+        for key in constants:
+            if np.any(np.asarray(spectTableData[key]) != constants[key]):
+                raise ValueError("%s column %s is not constant" % (tableName, key))
+        keys = sorted(k for k in names if k not in constants)
+        values = [np.asarray(spectTableData[k]) for k in keys]
+        if tableName not in self.tableDict:
+            # We are encountering this table for the first time, so we
+            #  need to build up colDict whose keys are the column names and
+            #  whose values are the subclasses of Col used by pytables to
+            #  define the HDF5 column. These are retrieved from colByName.
+            colDict = {}
+            # Use numpy to get the dtype names for the various data
+            for key, value in zip(keys, values):
+                colDict[key] = colByName[value.dtype.name]()
+            self.tableDict[tableName] = self.hdf5Handle.create_table(
+                self.where,
+                tableName,
+                colDict,
+                filters=self.hdf5Filters,
+                **self.tableOptions
+            )
+        table = self.tableDict[tableName]
+        if isinstance(spectTableData, np.ndarray) and spectTableData.dtype == table.dtype:
+            records = spectTableData
+        else:
+            # one record array in the layout of the table, filled a column at a time
+            records = np.empty(len(values[0]), dtype=table.dtype)
+            for key, value in zip(keys, values):
+                records[key] = value
+        table.append(records)
+        table.flush()
+
+    def _writeConstants(self, tableName, spectTableData, constant):
+        if constant is None:
+            constant = _column_names(spectTableData)
+        constants = {}
+        for key in sorted(constant):
+            value = np.asarray(spectTableData[key])
+            if value.size and np.all(value == value[0]):
+                constants[key] = value[:1]
+        if len(constants) == len(_column_names(spectTableData)):
+            # keep one column in the main table, it carries the number of rows
+            constants.pop(sorted(constants)[0])
+        self.constantDict[tableName] = {key: value[0] for key, value in constants.items()}
+        if not constants:
+            return
+        if CONSTANT_GROUP not in self.where:
+            self.hdf5Handle.create_group(self.where, CONSTANT_GROUP)
+        colDict = dict((key, colByName[value.dtype.name]()) for key, value in constants.items())
+        table = self.hdf5Handle.create_table(
+            self.where._f_get_child(CONSTANT_GROUP),
+            tableName,
+            colDict,
+            chunkshape=(1,),
+        )
+        row = table.row
+        for key, value in constants.items():
+            row[key] = value[0]
+        row.append()
+        table.flush()
+
+    def close(self):
+        if self.ownHandle:
+            self.hdf5Handle.close()
+        else:
+            self.hdf5Handle.flush()
+
+
+def _column_names(spectTableData):
+    """column names of a table given as a dictionary or as a structured array."""
+    if isinstance(spectTableData, np.ndarray):
+        return list(spectTableData.dtype.names)
+    return list(spectTableData)
+
+
+def fillRdfTables(fileName, spectrumDict, attrs=None, compression=None, sparse=False):
     """Save data from spectrumDict to tables in an HDF5 output file.
 
     Args:
         fileName: Name of HDF5 file to receive spectra
         spectrumDict: This is a dictionary corresponding to 1 optical file/one spectrum. It consists
-            of a dictionary with keys "rdData", "sensorData", "tagalongData" and "controlData". The
+            of a dictionary with keys "rdData", "sensorData", "tagalongData", "controlData" and
+            "spectrumIndex". The
             values are tables of data (stored as a dictionary whose keys are the column names and whose
             values are lists of the column data) which are to be written to the output file.
         attrs: Dictionary of attributes to be written to HDF5 file
+        compression: Dictionary of HDF5 compression settings, see DEFAULT_COMPRESSION
+        sparse: store constant columns once instead of in every row, see RdfWriter
     """
-    hdf5Filters = Filters(complevel=1, fletcher32=True)
+    writer = None
     try:
-        hdf5Handle = open_file(fileName, "w")
-        if attrs is not None:
-            for a in attrs:
-                setattr(hdf5Handle.root._v_attrs, a, attrs[a])
-        # Lookup table giving pyTables column generation function keyed
-        # by the numpy dtype.name
-        colByName = dict(
-            float32=Float32Col,
-            float64=Float64Col,
-            int16=Int16Col,
-            int32=Int32Col,
-            int64=Int64Col,
-            uint16=UInt16Col,
-            uint32=UInt32Col,
-            uint64=UInt64Col,
-        )
-
-        # We make HDF5 tables and define the columns needed in these tables
-        tableDict = {}
-        # Iterate over rdData, sensorData, tagalongData and controlData tables
+        writer = RdfWriter(fileName, attrs, compression, sparse)
+        # Iterate over rdData, sensorData, tagalongData, controlData and spectrumIndex tables
         for tableName in spectrumDict:
-            if tableName in [
-                "rdData",
-                "sensorData",
-                "tagalongData",
-                "controlData",
-            ]:
-                spectTableData = spectrumDict[tableName]
-                if len(spectTableData) > 0:
-                    keys, values = list(zip(*sorted(spectTableData.items())))
-                    if tableName not in tableDict:
-                        # We are encountering this table for the first time, so we
-                        #  need to build up colDict whose keys are the column names and
-                        #  whose values are the subclasses of Col used by pytables to
-                        #  define the HDF5 column. These are retrieved from colByName.
-                        colDict = {}
-                        # Use numpy to get the dtype names for the various data
-                        values = [np.asarray(v) for v in values]
-                        for key, value in zip(keys, values):
-                            colDict[key] = colByName[value.dtype.name]()
-                        tableDict[tableName] = hdf5Handle.create_table(
-                            hdf5Handle.root,
-                            tableName,
-                            colDict,
-                            filters=hdf5Filters,
-                        )
-                    table = tableDict[tableName]
-                    # Go through the arrays in values and fill up each row of the table
-                    #  one element at a time
-                    row = table.row
-                    for j in range(len(values[0])):
-                        for i, key in enumerate(keys):
-                            try:
-                                row[key] = values[i][j]
-                            except KeyError:
-                                pass
-                        row.append()
-                    table.flush()
+            if tableName in RDF_TABLES:
+                writer.append(tableName, spectrumDict[tableName])
     except:
         print(traceback.format_exc())
     finally:
-        hdf5Handle.close()
+        if writer is not None:
+            writer.close()
 
 
 #fixing to a new center of circle
 #this assumes no large outliers
 
+class CircleFit(object):
+    """Least-squares circle fit that is updated a block of points at a time.
+
+    The fit solves A @ C = B with A = [X, Y, 1] and B = X**2 + Y**2, but only keeps the normal
+    equation sums A.T @ A (3x3) and A.T @ B (3), so memory does not grow with the number of points
+    and fits of different chunks (or files) can be merged by adding their sums.
+    """
+    def __init__(self):
+        self.ATA = np.zeros((3, 3))
+        self.ATB = np.zeros(3)
+
+    def update(self, X, Y):
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        B = X * X + Y * Y
+        sx, sy = X.sum(), Y.sum()
+        sxy = X @ Y
+        self.ATA += [[X @ X, sxy, sx],
+                     [sxy, Y @ Y, sy],
+                     [sx, sy, X.size]]
+        self.ATB += [X @ B, Y @ B, B.sum()]
+        return self
+
+    def merge(self, other):
+        self.ATA += other.ATA
+        self.ATB += other.ATB
+        return self
+
+    def solve(self):
+        """return (x_center, y_center, radius)"""
+        #see https://lucidar.me/en/mathematics/least-squares-fitting-of-circle/ for math
+        C = np.linalg.solve(self.ATA, self.ATB)
+
+        x_center = C[0] / 2
+        y_center = C[1] / 2
+        radius = np.sqrt(4*C[2] + C[0]**2 + C[1]**2)/2
+
+        return x_center, y_center, radius
+
+
 def find_circle_centers(X,Y):
-    #see https://lucidar.me/en/mathematics/least-squares-fitting-of-circle/ for math
+    return CircleFit().update(X, Y).solve()
+
+
+def reuse_circle(previous, fit, drift):
+    """circle of an optical file, reusing the circle of the previous file of the same session.
 
-    A = np.vstack([X,Y,np.ones(X.size)]).T
-    B = X**2 + Y**2
-    C = np.linalg.pinv(A) @ B
+    If the center and radius fitted for this file are within drift (ratio units) of the previous
+    circle, the previous circle is returned, so consecutive files of a session share the same angle
+    reference; otherwise the new circle is.
 
-    x_center = C[0] / 2
-    y_center = C[1] / 2
-    radius = np.sqrt(4*C[2] + C[0]**2 + C[1]**2)/2
+    Args:
+        previous: circle used for the previous file of the session, or None
+        fit: CircleFit of this file
+        drift: largest change of center or radius to reuse the previous circle, 0 to never reuse
+    """
+    circle = fit.solve()
+    if drift and previous is not None:
+        if (np.hypot(circle[0] - previous[0], circle[1] - previous[1]) < drift
+                and abs(circle[2] - previous[2]) < drift):
+            return previous
+    return circle
 
-    return x_center, y_center, radius
 
+def fit_file_circle(op):
+    """worker side of plan_circles: CircleFit of one optical file, from its two ratio columns only."""
+    ratios = pd.read_csv(os.path.join(optical_folder_path, op + '.csv'), usecols=["ratio1", "ratio2"],
+                         float_precision="round_trip")
+    return CircleFit().update(ratios["ratio1"].to_numpy(), ratios["ratio2"].to_numpy())
 
-def convert_to_rdf(optical_path, sensor_data_list, out_path, cal_file):
-    """combine optical file and its corresponding sensor data then save as RDF h5 file.
+
+def plan_circles(pool, ops, drift, fit_folder=None):
+    """choose the wavemeter circle of every optical file in file-name order, see reuse_circle.
+
+    The pool workers fit the files in parallel; this process only chooses the circles, in
+    file-name order, so the circles do not depend on which worker converts which file. The files
+    are not fitted again when they are converted. With fit_folder (in work_dir for a distributed
+    merge), the fit sums are saved there as <op>.npz, and the machines that start later read them
+    instead of reading the ratio columns again.
+
+    Returns:
+        {optical file name: (x_center, y_center, radius)}
+    """
+    ops = sorted(ops)
+    fits = {}
+    if fit_folder is not None:
+        os.makedirs(fit_folder, exist_ok=True)
+        for op in ops:
+            try:
+                with np.load(os.path.join(fit_folder, op + ".npz")) as z:
+                    fits[op] = CircleFit()
+                    fits[op].ATA, fits[op].ATB = z["ATA"], z["ATB"]
+            except (OSError, ValueError, KeyError):  # not fitted yet, or being written
+                fits.pop(op, None)
+    todo = [op for op in ops if op not in fits]
+    for op, fit in zip(todo, pool.imap(fit_file_circle, todo)):
+        fits[op] = fit
+        if fit_folder is not None:
+            temp = os.path.join(fit_folder, "%s.%s.tmp.npz" % (op, os.getpid()))
+            np.savez(temp, ATA=fit.ATA, ATB=fit.ATB)
+            os.replace(temp, os.path.join(fit_folder, op + ".npz"))
+
+    circles = {}
+    previous = None
+    for op in ops:
+        previous = reuse_circle(previous, fits[op], drift)
+        circles[op] = previous
+    return circles
+
+
+def load_laser_cal(cal_file):
+    """Load the laser calibration used to convert wavemeter ratios to wavenumber.
+
+    The calibration is loaded once per process and kept until the cal file changes on disk.
+    """
+    return _load_laser_cal(os.path.abspath(cal_file), os.path.getmtime(cal_file))
+
+
+@lru_cache(maxsize=4)
+def _load_laser_cal(cal_file, mtime):
+    # mtime is only part of the cache key, so that an updated cal file is loaded again
+    from laser_cal import Laser_Cal
+    laser_cal_obj = Laser_Cal()
+    laser_cal_obj.load_cal(cal_file, only_phi_to_freq=True)
+    return laser_cal_obj
+
+
+def recalc_wlm_angle(rd_data, circle):
+    """Recalculate the wavemeter angle about the fitted circle center (x_center, y_center, radius)."""
+    x_center, y_center, radius = circle
+
+    # import matplotlib.pyplot as plt  # only when plotting, it is slow to import in every worker
+    # plt.figure(figsize=(6,6))
+    # plt.plot(rd_data["ratio1"], rd_data["ratio2"], ".")
+    # circle1 = plt.Circle((x_center, y_center), radius, edgecolor='r', fill=False, linewidth=2, zorder=10)
+    # plt.gca().add_patch(circle1)
+    # plt.title("find circle center")
+
+    wlm_angle_recalc = np.arctan2(rd_data["ratio2"] - y_center, rd_data["ratio1"] - x_center)
+    wlm_angle_recalc = rd_data['anglesSetpoint'] - np.pi + (wlm_angle_recalc - rd_data['anglesSetpoint'] + np.pi) % (2*np.pi)
+    return wlm_angle_recalc
+
+
+C_LIGHT = 29979.2458  # speed of light, cm / us
+# UNIX epoch in picarro time (ms since 0001-01-01)
+UNIX_ORIGIN_MS = (datetime.datetime(1970, 1, 1) - datetime.datetime(datetime.MINYEAR, 1, 1)) // datetime.timedelta(milliseconds=1)
+
+
+def picarro_timestamp(u, out):
+    """UNIX time (s) -> picarro timestamp (ms), as unixTimeToTimestamp: rounded to the microsecond
+    (half to even), then down to the ms. Exact for epoch times, where the fraction of a second has
+    few enough bits for frac * 1e6 to be exact."""
+    seconds = np.floor(u)
+    us = seconds.astype(np.int64) * 1000000 + np.rint((u - seconds) * 1e6).astype(np.int64)
+    np.floor_divide(us, 1000, out=out)
+    out += UNIX_ORIGIN_MS
+
+
+# transforms of RD_DATA_MAP: f(out column, *optical columns, scratch) writes the rdData column in place;
+# scratch is a float64 array of the same length, reused by every column
+RD_TRANSFORMS = {
+    "timestamp": lambda out, u, scratch: picarro_timestamp(u, out),
+    # ringdown time (us) -> ppm/cm
+    "absorbance": lambda out, t, scratch: np.divide(1e6, np.multiply(C_LIGHT, t, out=scratch), out=out),
+    "ratio": lambda out, r, scratch: np.copyto(out, np.rint(np.multiply(r, 32768, out=scratch), out=scratch),
+                                               casting="unsafe"),
+    "mean": lambda out, a, b, scratch: np.divide(np.add(a, b, out=scratch), 2, out=out),
+}
+
+# rdData columns from the optical columns: (rdData column, optical column(s), transform, dtype)
+#   transform: None copies the column (integer columns are truncated, as astype(int) does), a name
+#              of RD_TRANSFORMS, or a number to fill the column with
+#   dtype: None keeps the type of the optical column
+# rdData_key columns not listed here are columns we have no data for and stay 0 (int64), except
+# sequenceNumber, waveNumber and angleSetpoint which build_rd_data fills
+RD_DATA_MAP = [
+    ("timestamp", "timestamp", "timestamp", np.int64),  # UNIX epoch time in s -> picarro timestamp in ms
+    ("wlmAngle", "wlm_angle", None, np.float64),
+    ("waveNumberSetpoint", "waveNumberSetpoint", None, np.float64),
+    ("uncorrectedAbsorbance", "ringdown_time", "absorbance", np.float64),
+    # correctedAbsorbance: obsolete; status: ?????
+    ("count", (), 1, np.int64),
+    ("pztValue", "Cavity_phase", None, np.float64),
+    ("laserUsed", (), 1, np.int64),
+    ("subschemeId", "subschemeID", None, np.int64),  # includes fit flag 32768, 16384 ignore, 8192 is pzt center, 4096 enable cal
+    ("schemeRow", "schemeRow", None, np.int64),
+    ("ratio1", "ratio1", "ratio", np.int64),
+    ("ratio2", "ratio2", "ratio", np.int64),
+    ("coarseLaserCurrent", "laser_phase", None, np.int64),
+    ("fitAmplitude", "fit_amplitude", None, np.float64),
+    ("fitBackground", "fit_offset", None, np.float64),
+    ("fitRmsResidual", "fit_rms_residual", None, np.float64),
+    ("frontMirrorDac", "front_mirror", None, np.int64),
+    ("backMirrorDac", "back_mirror", None, np.int64),
+    ("gainCurrentDac", "laser_gain", None, np.int64),
+    ("soaCurrentDac", "laser_SOA", None, np.int64),
+    ("coarsePhaseDac", "laser_phase", None, np.int64),  # before phase temp correction
+    ("extra1", "extra1", None, np.int64),
+    ("extra2", "extra2", None, np.int64),
+    ("extra3", "extra3", None, np.int64),
+    ("extra4", "extra4", None, np.int64),
+    ("average1", ("wlm_eta1", "wlm_ref1"), "mean", np.float64),
+    ("average2", ("wlm_eta2", "wlm_ref2"), "mean", np.float64),
+    ("modeIndex", "modeIndex", None, np.int64),
+    # pztCntrlRef, cosPztCntrlRef, sinPztCntrlRef: fast pzt
+    # dont have schemeVersionAndTable, adding a fake. Everything is going to be from scheme table 1 with
+    # python scheme version (1): 17 for all rd (16 * schemeVersion + schemeTable)
+    ("schemeVersionAndTable", (), 17, np.int64),
+    ("cavityPressure", (), 140.0, np.float64),  # needs merging
+    # new keys being added
+    ("opticalPhase", "OF_phase", None, np.float64),
+    ("eta1", "wlm_eta1", None, np.float64),
+    ("eta2", "wlm_eta2", None, np.float64),
+    ("ref1", "wlm_ref1", None, np.float64),
+    ("ref2", "wlm_ref2", None, np.float64),
+    ("dwells", "dwells", None, np.int64),
+    ("OF_tune", "OF_tune", None, np.float64),
+    ("transient_mult", "transient_mult", None, np.float64),
+    ("FSRDisplaced", "FSRDisplaced", None, np.int64),
+    ("laser_gain", "laser_gain", None, None),
+    ("laser_SOA", "laser_SOA", None, None),
+]
+RD_FILLED = {"sequenceNumber": np.int64, "waveNumber": np.float64, "angleSetpoint": np.float64}
+# columns we have no data for, stored as constants by sparse files
+RD_ABSENT = sorted(set(rdData_key) - set(m[0] for m in RD_DATA_MAP) - set(RD_FILLED))
+
+
+@lru_cache(maxsize=None)
+def compile_rd_mapping(optical_dtype):
+    """compile RD_DATA_MAP for optical rows of a given dtype, once per dtype.
+
+    Returns:
+        (dtype of the rdData structured array, with the columns in name order as in the h5 table;
+        [(rdData column, optical columns, transform or fill value)] in map order)
+    """
+    types = dict((name, np.dtype(np.int64)) for name in RD_ABSENT)
+    types.update((name, np.dtype(t)) for name, t in RD_FILLED.items())
+    steps = []
+    for target, sources, transform, dtype in RD_DATA_MAP:
+        sources = (sources,) if isinstance(sources, str) else tuple(sources)
+        for source in sources:
+            if source not in optical_dtype.names:
+                raise KeyError("optical column %s (for rdData %s) not found" % (source, target))
+        types[target] = np.dtype(dtype) if dtype is not None else optical_dtype[sources[0]]
+        if isinstance(transform, str):
+            transform = RD_TRANSFORMS[transform]
+        steps.append((target, sources, transform))
+    return np.dtype([(name, types[name]) for name in sorted(types)]), steps
+
+
+def build_rd_data(rd_data, laser_cal_obj=None, circle=None, first_sequence=1):
+    """convert rows of the optical data to the rdData table.
+
+    The columns are written in place into one preallocated structured array, following the
+    compiled RD_DATA_MAP.
+
+    Args:
+        rd_data: numpy structured array of optical data, one row per ringdown
+        laser_cal_obj: Laser_Cal used for waveNumber; if None, angleSetpoint is recalculated from circle
+        circle: (x_center, y_center, radius) of the wavemeter circle, used when there is no cal file
+        first_sequence: sequenceNumber of the first row, so that chunks keep counting up
+    Returns:
+        structured array of the rdData columns; the columns of RD_ABSENT are 0
+    """
+    num_rd = rd_data['timestamp'].size
+    dtype, steps = compile_rd_mapping(rd_data.dtype)
+    rdData = np.zeros(num_rd, dtype=dtype)
+    scratch = np.empty(num_rd)
+    for target, sources, transform in steps:
+        out = rdData[target]
+        if transform is None:
+            np.copyto(out, rd_data[sources[0]], casting="unsafe")
+        elif callable(transform):
+            transform(out, *[rd_data[source] for source in sources], scratch)
+        else:
+            out.fill(transform)
+    rdData["sequenceNumber"] = np.arange(first_sequence, first_sequence + num_rd)  # continually incrementing
+
+    if laser_cal_obj is not None:
+        rdData["waveNumber"] = laser_cal_obj.convert_ratios_to_freq(
+                                                    rd_data['waveNumberSetpoint'],
+                                                    rd_data["ratio1"],
+                                                    rd_data["ratio2"])
+        rdData["angleSetpoint"] = rd_data['anglesSetpoint']
+    else:
+        rdData["waveNumber"] = rd_data['waveNumberSetpoint']
+        rdData["angleSetpoint"] = recalc_wlm_angle(rd_data, circle)
+
+    return rdData
+
+
+def build_control_data(subschemeId, last_fit=-1, first_row=0):
+    """count the ringdowns in each spectrum (from one fit flag to the next).
+
+    Args:
+        subschemeId: subschemeId column of rdData, fit flag is 32768
+        last_fit: row index of the last fit flag before this block, -1 at the start of the file
+        first_row: row index of the first row of this block in the whole file
+    Returns:
+        (controlData dictionary, row index of the last fit flag seen so far)
+    """
+    fit_flag = subschemeId // 32768 == 1
+    fit_rows = first_row + np.nonzero(fit_flag)[0]
+    num_spectra = fit_rows.size
+    controlData = {}
+    controlData['RDDataSize'] = np.diff(np.concatenate((np.asarray([last_fit]), fit_rows)))
+    controlData['SpectrumQueueSize'] = np.zeros(num_spectra)
+    controlData['Latency'] = np.zeros(num_spectra)
+    if num_spectra:
+        last_fit = fit_rows[-1]
+    return controlData, last_fit
+
+
+class SpectrumIndex(object):
+    """Rows and time range of every spectrum, for the spectrumIndex table.
+
+    A spectrum runs from the row after a fit flag to the next fit flag (included), like RDDataSize
+    in controlData; rows after the last fit flag belong to no spectrum. update() takes the optical
+    rows a block at a time, table() adds the matching sensorData rows once they are known.
+    """
+    def __init__(self):
+        self.num_rows = 0
+        self.start_row = 0  # first row of the spectrum not finished yet
+        self.start_time = None
+        self.start = []
+        self.end = []
+        self.t_start = []
+        self.t_end = []
+
+    def update(self, subschemeId, epoch):
+        """add a block of optical rows.
+
+        Args:
+            subschemeId: subschemeId column of rdData, fit flag is 32768
+            epoch: optical timestamps of the rows, unix time in s
+        """
+        epoch = np.asarray(epoch, dtype=np.float64)
+        if self.start_time is None and epoch.size:
+            self.start_time = epoch[0]
+        fit_rows = np.nonzero(np.asarray(subschemeId) // 32768 == 1)[0]
+        if fit_rows.size:
+            ends = self.num_rows + fit_rows + 1
+            self.start.append(np.concatenate(([self.start_row], ends[:-1])))
+            self.end.append(ends)
+            self.t_start.append(np.concatenate(([self.start_time], epoch[fit_rows[:-1] + 1])))
+            self.t_end.append(epoch[fit_rows])
+            self.start_row = ends[-1]
+            self.start_time = epoch[fit_rows[-1] + 1] if fit_rows[-1] + 1 < epoch.size else None
+        self.num_rows += epoch.size
+
+    def table(self, sensor_timestamp):
+        """spectrumIndex columns; end rows are exclusive, so spectrum k is rdData[startRow:endRow].
+
+        Args:
+            sensor_timestamp: timestamp column of sensorData (sensor clock, in time order)
+        Returns:
+            dictionary of spectrumIndex columns, timestamps in ms like rdData["timestamp"]
+        """
+        start = np.concatenate(self.start + [np.zeros(0)]).astype(np.int64)
+        end = np.concatenate(self.end + [np.zeros(0)]).astype(np.int64)
+        t_start = np.concatenate(self.t_start + [np.zeros(0)])
+        t_end = np.concatenate(self.t_end + [np.zeros(0)])
+        sensor_timestamp = np.asarray(sensor_timestamp, dtype=np.float64)
+        return {
+            "startRow": start,
+            "endRow": end,
+            "startTimestamp": np.asarray([unixTimeToTimestamp(t) for t in t_start], dtype=np.int64),
+            "endTimestamp": np.asarray([unixTimeToTimestamp(t) for t in t_end], dtype=np.int64),
+            # sensor rows recorded while the spectrum was measured
+            "sensorStartRow": np.searchsorted(sensor_timestamp, t_start + OPTICAL_TIME_OFFSET, "left").astype(np.int64),
+            "sensorEndRow": np.searchsorted(sensor_timestamp, t_end + OPTICAL_TIME_OFFSET, "right").astype(np.int64),
+        }
+
+
+def build_sensor_data(combined_df):
+    """pick the sensorData columns from the sensor DataFrame; if key not exist, fill with zero."""
+    sensorData = {}
+    rows, cols = combined_df.shape
+    zero_list = [0] * rows
+    for item in sensorData_key:
+        try:
+            sensorData[item] = combined_df[item].tolist()
+        except:
+            sensorData[item] = zero_list
+    return sensorData
+
+
+def build_spectrum_dict(optical_path, sensor_data_list, cal_file, circle=None, store=None):
+    """combine optical file and its corresponding sensor data into a spectrumDict.
 
     Args:
         optical_path: path of optical data csv
         sensor_data_list: list of paths of all sensor data csv files for this optical file
-        out_path: path of output h5 file, will have the same file name as optical file
         cal_file
+        circle: wavemeter circle chosen by plan_circles; None: fit the circle of this file
+        store: SensorStore to read the sensor files through its cache (all columns are then float64)
+    Returns:
+        spectrumDict, see fillRdfTables
     """
 
     # rd_data = pd.read_csv(optical_path)
@@ -129,32 +643,16 @@ def convert_to_rdf(optical_path, sensor_data_list, out_path, cal_file):
                         dtype=None, encoding='utf-8')
 
     ##########################################################
-    num_rd = rd_data['timestamp'].size
-
     # cal_file = R"laser_cal.npz"
+    laser_cal_obj = None
     if cal_file is not None:
-        from laser_cal import Laser_Cal
-        laser_cal_obj = Laser_Cal()
-        laser_cal_obj.load_cal(cal_file, only_phi_to_freq=True)
-        have_cal_file = True
-    else:
-        have_cal_file = False
-
-        x_center, y_center, radius = find_circle_centers(
+        laser_cal_obj = load_laser_cal(cal_file)
+        circle = None
+    elif circle is None:
+        circle = find_circle_centers(
         rd_data["ratio1"],
         rd_data["ratio2"])
 
-        # plt.figure(figsize=(6,6))
-        # plt.plot(rd_data["ratio1"], rd_data["ratio2"], ".")
-        # circle1 = plt.Circle((x_center, y_center), radius, edgecolor='r', fill=False, linewidth=2, zorder=10)
-        # plt.gca().add_patch(circle1)
-        # plt.title("find circle center")
-
-        wlm_angle_recalc = np.arctan2(rd_data["ratio2"] - y_center, rd_data["ratio1"] - x_center)
-        wlm_angle_recalc = rd_data['anglesSetpoint'] - np.pi + (wlm_angle_recalc - rd_data['anglesSetpoint'] + np.pi) % (2*np.pi)
-
-    # print(wlm_angle_recalc)
-
     spectrumDict = {
         "rdData": {},
         "sensorData": {},
@@ -164,128 +662,446 @@ def convert_to_rdf(optical_path, sensor_data_list, out_path, cal_file):
     }
 
     # 1. rdData
-    # initiate with zeros
-    zero_fill = [0] * num_rd
-    for item in rdData_key:
-        spectrumDict['rdData'][item] = zero_fill
-
-    # fill in data
-    c = 29979.2458 #speed of light cm / us
-    spectrumDict['rdData']["timestamp"] = np.asarray([unixTimeToTimestamp(t) for t in rd_data['timestamp']]) #UNIX epoch time in seconds -> picarro timestamp in ms
-    spectrumDict['rdData']["wlmAngle"] = rd_data['wlm_angle']
-    spectrumDict['rdData']["waveNumberSetpoint"] = rd_data["waveNumberSetpoint"]
-    spectrumDict['rdData']["uncorrectedAbsorbance"] = 1e6 / (c * rd_data['ringdown_time']) #unit conversion: us -> ppm/cm
-    # spectrumDict['rdData']["correctedAbsorbance"] = # obsolete
-    # spectrumDict['rdData']["status"] = ?????
-    spectrumDict['rdData']["count"] = np.ones(num_rd, dtype=int)
-    spectrumDict['rdData']["pztValue"] = rd_data['Cavity_phase']
-    spectrumDict['rdData']["laserUsed"] = np.ones(num_rd, dtype=int)
-    spectrumDict['rdData']["subschemeId"] = rd_data["subschemeID"].astype(int) #includes fit flag 32768, 16384 ignore, 8192 is pzt center, 4096 enable cal
-    spectrumDict['rdData']["schemeRow"] = rd_data['schemeRow'].astype(int)
-    spectrumDict['rdData']["ratio1"] = np.rint(rd_data["ratio1"] * 32768).astype(int)
-    spectrumDict['rdData']["ratio2"] = np.rint(rd_data["ratio2"] * 32768).astype(int)
-    spectrumDict['rdData']["coarseLaserCurrent"] = rd_data["laser_phase"].astype(int)
-    spectrumDict['rdData']["fitAmplitude"] = rd_data["fit_amplitude"]
-    spectrumDict['rdData']["fitBackground"] = rd_data["fit_offset"]
-    spectrumDict['rdData']["fitRmsResidual"] = rd_data['fit_rms_residual']
-    spectrumDict['rdData']["frontMirrorDac"] = rd_data['front_mirror'].astype(int)
-    spectrumDict['rdData']["backMirrorDac"] = rd_data['back_mirror'].astype(int)
-    spectrumDict['rdData']["gainCurrentDac"] = rd_data['laser_gain'].astype(int)
-    spectrumDict['rdData']["soaCurrentDac"] = rd_data['laser_SOA'].astype(int)
-    spectrumDict['rdData']["coarsePhaseDac"] = rd_data['laser_phase'].astype(int) # before phase temp correction
-    spectrumDict['rdData']["extra1"] = rd_data['extra1'].astype(int)
-    spectrumDict['rdData']["extra2"] = rd_data['extra2'].astype(int)
-    spectrumDict['rdData']["extra3"] = rd_data['extra3'].astype(int)
-    spectrumDict['rdData']["extra4"] = rd_data['extra4'].astype(int)
-    spectrumDict['rdData']["sequenceNumber"] = np.arange(1,num_rd+1) #continually incrementing
-    spectrumDict['rdData']["average1"] = (rd_data['wlm_eta1'] + rd_data['wlm_ref1']) / 2
-    spectrumDict['rdData']["average2"] = (rd_data['wlm_eta2'] + rd_data['wlm_ref2']) / 2
-    spectrumDict['rdData']["modeIndex"] = rd_data['modeIndex'].astype(int)
-    # spectrumDict['rdData']["pztCntrlRef"] = fast pzt
-    # spectrumDict['rdData']["cosPztCntrlRef"] = fast pzt
-    # spectrumDict['rdData']["sinPztCntrlRef"] = fast pzt
-
-    # dont have schemeVersionAndTable, adding a fake. Everything is going to be from scheme table 1 with python scheme version (1): 
-    # result is 17 for all rd (16 * schemeVersion + schemeTable) 
-    spectrumDict['rdData']["schemeVersionAndTable"] = 17 + np.zeros(num_rd).astype(int)
-
-    if have_cal_file:
-        spectrumDict['rdData']["waveNumber"] = laser_cal_obj.convert_ratios_to_freq(
-                                                    rd_data['waveNumberSetpoint'],
-                                                    rd_data["ratio1"],
-                                                    rd_data["ratio2"])
-        spectrumDict['rdData']["angleSetpoint"] = rd_data['anglesSetpoint']
-    else:
-        spectrumDict['rdData']["waveNumber"] = rd_data['waveNumberSetpoint']
-        spectrumDict['rdData']["angleSetpoint"] = wlm_angle_recalc
-
-    spectrumDict['rdData']["cavityPressure"] = 140 * np.ones(num_rd) # needs merging
-
-    # new keys being added
-    spectrumDict['rdData']["opticalPhase"] = rd_data['OF_phase']
-    spectrumDict['rdData']["eta1"] = rd_data['wlm_eta1']
-    spectrumDict['rdData']["eta2"] = rd_data['wlm_eta2']
-    spectrumDict['rdData']["ref1"] = rd_data['wlm_ref1']
-    spectrumDict['rdData']["ref2"] = rd_data['wlm_ref2']
-    spectrumDict['rdData']["dwells"] = rd_data['dwells'].astype(int)
-    spectrumDict['rdData']["OF_tune"] = rd_data['OF_tune']
-    spectrumDict['rdData']["transient_mult"] = rd_data['transient_mult']
-    spectrumDict['rdData']["FSRDisplaced"] = rd_data['FSRDisplaced'].astype(int)
-    spectrumDict['rdData']["laser_gain"] = rd_data['laser_gain']
-    spectrumDict['rdData']["laser_SOA"] = rd_data['laser_SOA']
+    spectrumDict['rdData'] = build_rd_data(rd_data, laser_cal_obj, circle)
 
     # 2. controlData
-    fit_flag = spectrumDict['rdData']["subschemeId"] // 32768 == 1
-    num_spectra = np.sum(fit_flag)
-    #this counts the ringdowns in each spectra (from one fit flag to the next)
-    spectrumDict["controlData"]['RDDataSize'] = np.diff(np.concatenate((np.asarray([-1]), np.nonzero(fit_flag)[0])))
-    spectrumDict["controlData"]['SpectrumQueueSize'] = np.zeros(num_spectra)
-    spectrumDict["controlData"]['Latency'] = np.zeros(num_spectra)
+    spectrumDict["controlData"], _ = build_control_data(spectrumDict['rdData']["subschemeId"])
 
     # 3. sensor data
     # stack all csv in the sensor data list
-    combined_df = pd.concat(map(pd.read_csv, sensor_data_list))  # , ignore_index=True)
+    if store is not None:
+        combined_df = pd.DataFrame(store.read_files(sensor_data_list))
+    else:
+        combined_df = pd.concat(map(pd.read_csv, sensor_data_list))  # , ignore_index=True)
+    spectrumDict["sensorData"] = build_sensor_data(combined_df)
+
+    # 4. spectrum index
+    index = SpectrumIndex()
+    index.update(spectrumDict['rdData']["subschemeId"], rd_data['timestamp'])
+    spectrumDict["spectrumIndex"] = index.table(combined_df["timestamp"].to_numpy())
+
+    return spectrumDict
 
-    # fill in df data; if key not exist, fill with zero
-    rows, cols = combined_df.shape
-    zero_list = [0] * rows
-    for item in sensorData_key:
-        try:
-            spectrumDict["sensorData"][item] = combined_df[item].tolist()
-        except:
-            spectrumDict["sensorData"][item] = zero_list
+
+def convert_to_rdf(optical_path, sensor_data_list, out_path, cal_file, compression=None, circle=None,
+                   sparse=False, store=None):
+    """combine optical file and its corresponding sensor data then save as RDF h5 file.
+
+    Args:
+        optical_path: path of optical data csv
+        sensor_data_list: list of paths of all sensor data csv files for this optical file
+        out_path: path of output h5 file, will have the same file name as optical file
+        cal_file
+        compression: HDF5 compression settings, see DEFAULT_COMPRESSION
+        circle: see build_spectrum_dict
+        sparse: store constant columns once, see RdfWriter
+        store: see build_spectrum_dict
+    """
+    spectrumDict = build_spectrum_dict(optical_path, sensor_data_list, cal_file, circle, store)
 
     # save spectrumDict to h5 file
-    fillRdfTables(out_path, spectrumDict)
+    fillRdfTables(out_path, spectrumDict, compression=compression, sparse=sparse)
+
+
+def convert_to_rdf_chunked(optical_path, sensor_data_list, out_path, cal_file, chunk_rows, compression=None,
+                           circle=None, sparse=False, store=None):
+    """same as convert_to_rdf, but reads the optical csv chunk_rows rows at a time and appends each
+    chunk to the h5 file, so peak memory is bounded by the chunk size instead of the file size.
+
+    Column types are taken from the first chunk of the optical file; a later chunk that does not fit
+    them (e.g. a float in an integer column) raises instead of being truncated. Sensor columns are
+    stored as float64 because each sensor csv is read and written on its own. With sparse=True, only
+    the columns we have no data for are stored as constants, since later chunks are not known yet.
+
+    Args:
+        optical_path: path of optical data csv
+        sensor_data_list: list of paths of all sensor data csv files for this optical file
+        out_path: path of output h5 file, will have the same file name as optical file
+        cal_file
+        chunk_rows: number of optical rows to convert at a time
+        compression: HDF5 compression settings, see DEFAULT_COMPRESSION
+        circle: see build_spectrum_dict
+        sparse: store constant columns once, see RdfWriter
+        store: see build_spectrum_dict
+    """
+    laser_cal_obj = None
+    if cal_file is not None:
+        laser_cal_obj = load_laser_cal(cal_file)
+        circle = None
+    elif circle is None:
+        # the circle fit needs every point before the angles can be recalculated: first pass over
+        # the two ratio columns only
+        fit = CircleFit()
+        for ratios in pd.read_csv(optical_path, usecols=["ratio1", "ratio2"], chunksize=chunk_rows,
+                                  float_precision="round_trip"):
+            fit.update(ratios["ratio1"].to_numpy(), ratios["ratio2"].to_numpy())
+        circle = fit.solve()
+
+    # round_trip parses floats exactly as np.genfromtxt does in convert_to_rdf
+    dtypes = pd.read_csv(optical_path, nrows=chunk_rows).dtypes.to_dict()
+
+    writer = RdfWriter(out_path, compression=compression, sparse=sparse)
+    try:
+        # 1. rdData and 2. controlData, one chunk at a time
+        num_rows = 0
+        last_fit = -1
+        index = SpectrumIndex()
+        for chunk in pd.read_csv(optical_path, chunksize=chunk_rows, dtype=dtypes,
+                                 float_precision="round_trip"):
+            rd_data = chunk.to_records(index=False)
+            rdData = build_rd_data(rd_data, laser_cal_obj, circle, first_sequence=num_rows + 1)
+            writer.append("rdData", rdData, constant=RD_ABSENT)
+            controlData, last_fit = build_control_data(rdData["subschemeId"], last_fit, num_rows)
+            writer.append("controlData", controlData, constant=[])
+            index.update(rdData["subschemeId"], rd_data["timestamp"])
+            num_rows += len(rd_data)
+
+        # 3. sensor data and 4. spectrum index
+        append_sensor_data(writer, sensor_data_list, index, store)
+    finally:
+        writer.close()
+
+
+def append_sensor_data(writer, sensor_data_list, index, store=None):
+    """append the sensor files one at a time (as float64), then the spectrumIndex table."""
+    sensor_timestamp = []
+    for p in sensor_data_list:
+        if store is not None:
+            df = pd.DataFrame(store.read_files([p], header))
+        else:
+            df = pd.read_csv(p, dtype=np.float64)
+        absent = [k for k in sensorData_key if k not in df.columns]
+        writer.append("sensorData", build_sensor_data(df), constant=absent)
+        sensor_timestamp.append(df["timestamp"].to_numpy())
+    writer.append("spectrumIndex", index.table(np.concatenate(sensor_timestamp + [np.zeros(0)])), constant=[])
+
+
+def plan_segments(optical_path, segment_rows, fit_circle=True):
+    """cut an optical file into segments of about segment_rows rows that end on a fit flag.
+
+    Reads only the subschemeID and ratio columns, then finds the byte range of every segment, so
+    each segment can be parsed on its own by a worker.
+
+    Returns:
+        (list of (first row, byte offset, byte length) per segment, CircleFit of all rows or None)
+    """
+    # only 3 columns, so the whole file at once: the circle is then fitted exactly as by convert_to_rdf
+    cols = pd.read_csv(optical_path, usecols=["subschemeID", "ratio1", "ratio2"], float_precision="round_trip")
+    fit = CircleFit().update(cols["ratio1"], cols["ratio2"]) if fit_circle else None
+    num_rows = len(cols)
+    ends = []  # row after the end of each segment
+    for r in np.nonzero(cols["subschemeID"].to_numpy().astype(int) // 32768 == 1)[0]:
+        if r + 1 - (ends[-1] if ends else 0) >= segment_rows:
+            ends.append(r + 1)
+    del cols
+    if not ends or ends[-1] < num_rows:
+        ends.append(num_rows)
+    starts = [0] + ends[:-1]
+
+    # byte offset of the first row of every segment, counting lines after the header
+    offsets = []
+    wanted = iter(starts + [num_rows])
+    target = next(wanted)
+    with open(optical_path, "rb") as f:
+        pos = len(f.readline())
+        line = 0
+        block = f.read(1 << 24)
+        while target is not None:
+            while line == target:
+                offsets.append(pos)
+                target = next(wanted, None)
+            if target is None:
+                break
+            # skip to the line of the next segment start inside this block, or to the end of the block
+            i = -1
+            while line < target:
+                i = block.find(b"\n", i + 1)
+                if i < 0:
+                    break
+                line += 1
+            if i < 0:
+                pos += len(block)
+                block = f.read(1 << 24)
+                if not block:
+                    offsets.extend([pos] * (len(starts) + 1 - len(offsets)))
+                    break
+                continue
+            pos += i + 1
+            block = block[i + 1:]
+    segments = [(starts[k], offsets[k], offsets[k + 1] - offsets[k]) for k in range(len(starts))]
+    return segments, fit
+
+
+def convert_to_rdf_split(pool, optical_path, sensor_data_list, out_path, cal_file, segment_rows, compression=None,
+                         circle=None, sparse=False, store=None, budget=0, processes=1):
+    """same as convert_to_rdf, but the optical rows are converted by the pool workers in segments
+    cut at spectrum boundaries, and written in order by this process, so one large file uses every core.
 
+    Column types are taken from the first segment_rows rows, see convert_to_rdf_chunked; with
+    sparse=True only the columns we have no data for are stored as constants.
 
-conf = load_conf()
-# print(conf)
-optical_folder_path = conf["optical_folder_path"]
-sensor_folder_path = conf["sensor_folder_path"]
-output_folder = conf["output_folder"]
+    Segments are started while the estimated memory of the segments not yet written (memory_per_byte x
+    bytes of the segment) fits in budget, and at most 2 x processes at once, see imap_ordered_bounded.
+
+    Args:
+        pool: multiprocessing pool whose workers ran init_worker
+        segment_rows: rows per segment, about
+        budget: bytes of estimated memory the segments in flight may use together (0: no limit)
+        processes: number of workers of the pool
+        others: see convert_to_rdf
+    """
+    segments, fit = plan_segments(optical_path, segment_rows, fit_circle=cal_file is None and circle is None)
+    if cal_file is not None:
+        circle = None
+    elif fit is not None:
+        circle = fit.solve()
+    dtypes = pd.read_csv(optical_path, nrows=segment_rows).dtypes.to_dict()
+    tasks = [(optical_path, first_row, offset, length, dtypes, cal_file, circle)
+             for first_row, offset, length in segments]
+    memory = [conf.get("memory_per_byte", 10) * length for first_row, offset, length in segments]
+
+    writer = RdfWriter(out_path, compression=compression, sparse=sparse)
+    try:
+        # 1. rdData and 2. controlData, in segment order
+        index = SpectrumIndex()
+        for rdData, controlData, epoch in imap_ordered_bounded(pool, convert_segment, tasks, memory, budget,
+                                                               processes):
+            writer.append("rdData", rdData, constant=RD_ABSENT)
+            writer.append("controlData", controlData, constant=[])
+            index.update(rdData["subschemeId"], epoch)
+
+        # 3. sensor data and 4. spectrum index
+        append_sensor_data(writer, sensor_data_list, index, store)
+    finally:
+        writer.close()
+
+
+def write_consolidated(results, output_folder, compression=None, sparse=False, existing_folder=None):
+    """write the spectra of many optical files into one h5 file per day, from a single process.
+
+    Each optical file becomes a group file_<optical file name> holding its rdData, sensorData and
+    controlData tables, in <output_folder>/<YYYYMMDD>.h5. The day files stay open until all results
+    are written, so the shared drive sees a few large files instead of one small file per optical file.
+
+    Args:
+        results: iterable of (optical file name, spectrumDict), e.g. from the pool workers
+        output_folder: folder of the per-day h5 files
+        compression: HDF5 compression settings, see DEFAULT_COMPRESSION
+        sparse: store constant columns once, see RdfWriter
+        existing_folder: when output_folder is a scratch folder, the folder the day files are uploaded to;
+            a day file already there is copied to output_folder first, so its groups are kept
+    Returns:
+        list of the optical file names written
+    """
+    handles = {}  # {day: open h5 file}
+    written = []
+    try:
+        for op, spectrumDict in results:
+            day = op[:8]
+            if day not in handles:
+                p = os.path.join(output_folder, day + ".h5")
+                if existing_folder is not None and not os.path.exists(p):
+                    existing = os.path.join(existing_folder, day + ".h5")
+                    if os.path.exists(existing):
+                        shutil.copy2(existing, p)
+                handles[day] = open_file(p, "a")
+            writer = RdfWriter(handles[day], {"opticalFile": op}, compression, sparse, group="file_" + op)
+            try:
+                for tableName in RDF_TABLES:
+                    if tableName in spectrumDict:
+                        writer.append(tableName, spectrumDict[tableName])
+            finally:
+                writer.close()
+            written.append(op)
+    finally:
+        for h in handles.values():
+            h.close()
+    return written
 
-def work_log(op, matchDict):
-    lst = os.listdir(output_folder)
-    x = len(lst)
-    if x and x % 20 == 0:
-        print("... %s RDF files created" % x)
 
-    if matchDict[op]:
+# modules imported once by the forkserver, so that workers start without importing them again
+PRELOAD_MODULES = ["__main__", "numpy", "pandas", "tables"]
+
+# set by init_worker, in the main process and in every pool worker
+conf = None
+optical_folder_path = None
+sensor_folder_path = None
+output_folder = None
+write_folder = None  # output_folder, or the local scratch folder when staging
+chunk_rows = 0
+compression = None
+cal_file = None
+circles = {}  # {optical file name: wavemeter circle}, chosen by plan_circles when circles are reused
+sparse = False
+work = None  # WorkDir of a distributed merge
+store = None  # SensorStore when sensor_cache_folder is set
+parquet_folder = None  # also export every output file as Parquet here
+
+
+def init_worker(worker_conf=None, worker_circles=None):
+    """load the configuration (and calibration) once per process.
+
+    Used as the Pool initializer: the main process reads config.yaml once and passes it to every
+    worker, so workers do not read it again, and the cal file is loaded before the first task.
+
+    Args:
+        worker_conf: configuration dictionary; if None, config.yaml is read
+        worker_circles: circles chosen by the main process, see plan_circles
+    """
+    global conf, optical_folder_path, sensor_folder_path, output_folder, chunk_rows, compression, cal_file
+    global circles, sparse, work, write_folder, store, parquet_folder
+    if worker_conf is None:
+        worker_conf = load_conf()
+    conf = worker_conf
+    optical_folder_path = conf["optical_folder_path"]
+    sensor_folder_path = conf["sensor_folder_path"]
+    output_folder = conf["output_folder"]
+    write_folder = conf.get("scratch_folder") or output_folder
+    chunk_rows = conf.get("chunk_rows", 0)  # 0: convert each optical file in one piece
+    compression = conf.get("rdf_compression")
+    cal_file = conf.get("cal_file")
+    circles = worker_circles or {}
+    sparse = conf.get("sparse_columns", False)
+    parquet_folder = conf.get("parquet_folder")
+    if conf.get("sensor_cache_folder"):
+        store = SensorStore(sensor_folder_path, conf["sensor_cache_folder"], save_interval=conf.get("save_interval", 60))
+    if conf.get("work_dir"):
+        work = WorkDir(conf["work_dir"], conf.get("lease_time", 600))
+    if cal_file is not None:
+        load_laser_cal(cal_file)
+
+
+def work_log(op, sensor_data_list):
+    """convert one optical file; returns "ok", "failed" or "no sensor data"."""
+    if sensor_data_list:
         p1 = os.path.join(optical_folder_path, op + '.csv')
-        out_path = os.path.join(output_folder, op + '.h5')
+        out_path = os.path.join(write_folder, op + '.h5')
         try:
-            convert_to_rdf(p1, matchDict[op], out_path, None)
+            if chunk_rows:
+                convert_to_rdf_chunked(p1, sensor_data_list, out_path, cal_file, chunk_rows, compression,
+                                       circles.get(op), sparse, store)
+            else:
+                convert_to_rdf(p1, sensor_data_list, out_path, cal_file, compression, circles.get(op), sparse,
+                               store)
             # print("created RDF for optical file: %s.csv" % op)
+            export_log(out_path, op)
+            return "ok"
         except:
             print("Failed to create RDF file for: %s.csv " % op)
+            remove_scratch(out_path)
+            return "failed"
     else:
         print("No sensor data for optical file: %s.csv" % op)
+        return "no sensor data"
 
 
-if __name__ == "__main__":
+def remove_scratch(out_path):
+    """remove what a failed conversion left in scratch_folder; without scratch_folder the file is kept."""
+    if write_folder != output_folder:
+        try:
+            os.remove(out_path)
+        except OSError:
+            pass  # not created
+
+
+def export_log(path, op, where="/"):
+    """export an output file to parquet_folder, if set; a failed export is reported, the h5 file is kept."""
+    if not parquet_folder:
+        return
+    try:
+        export_parquet(path, parquet_folder, op, where, conf.get("parquet_level", 3))
+    except Exception as e:
+        print("! Parquet export failed for %s: %s" % (op, e))
+
+
+def work_log_split(pool, op, sensor_data_list, split_bytes, budget=0, processes=1):
+    """convert one large optical file with every worker of the pool, see convert_to_rdf_split;
+    returns the status as work_log does."""
+    p1 = os.path.join(optical_folder_path, op + '.csv')
+    out_path = os.path.join(write_folder, op + '.h5')
+    try:
+        segment_rows = max(1, int(split_bytes / bytes_per_row(p1)))
+        convert_to_rdf_split(pool, p1, sensor_data_list, out_path, cal_file, segment_rows, compression,
+                             circles.get(op), sparse, store, budget, processes)
+        export_log(out_path, op)
+        return "ok"
+    except:
+        print("Failed to create RDF file for: %s.csv " % op)
+        remove_scratch(out_path)
+        return "failed"
+
+
+def work_log_star(args):
+    return args[0], work_log(*args)
+
+
+def build_task(args):
+    """worker side of the per-day output mode: build the spectrumDict and send it to the writer.
+
+    Returns:
+        (optical file name, status of work_log, spectrumDict or None)
+    """
+    op, sensor_data_list = args
+    if not sensor_data_list:
+        print("No sensor data for optical file: %s.csv" % op)
+        return op, "no sensor data", None
+    try:
+        p1 = os.path.join(optical_folder_path, op + '.csv')
+        return op, "ok", build_spectrum_dict(p1, sensor_data_list, cal_file, circles.get(op), store)
+    except:
+        print("Failed to create RDF file for: %s.csv " % op)
+        return op, "failed", None
+
+
+def convert_segment(args):
+    """worker side of convert_to_rdf_split: convert the optical rows of one segment.
+
+    Returns:
+        (rdData, controlData, optical timestamps)
+    """
+    optical_path, first_row, offset, length, dtypes, segment_cal_file, circle = args
+    with open(optical_path, "rb") as f:
+        head = f.readline()
+        f.seek(offset)
+        data = f.read(length)
+    rd_data = pd.read_csv(io.BytesIO(head + data), dtype=dtypes, float_precision="round_trip").to_records(index=False)
+    laser_cal_obj = load_laser_cal(segment_cal_file) if segment_cal_file is not None else None
+    rdData = build_rd_data(rd_data, laser_cal_obj, circle, first_sequence=first_row + 1)
+    # a segment starts right after a fit flag
+    controlData, _ = build_control_data(rdData["subschemeId"], first_row - 1, first_row)
+    return rdData, controlData, np.asarray(rd_data["timestamp"])
+
+
+def work_log_claimed(args):
+    """work_log for a distributed merge: only convert the optical file if this process gets its lease.
+
+    When staging, a converted file is only marked done by the main process once it is uploaded.
+
+    Returns:
+        (optical file name, status of work_log or None if another node has the file, seconds)
+    """
+    op, sensor_data_list = args
+    if not work.claim(op):
+        return op, None, 0
     t0 = time.time()
+    try:
+        with LeaseRenewer(work, op):
+            status = work_log(op, sensor_data_list)
+    except BaseException:
+        work.release(op)
+        raise
+    seconds = time.time() - t0
+    if write_folder == output_folder or status != "ok":
+        work.done(op, status, seconds)
+    return op, status, seconds
+
 
+def match_sensor_files(optical_folder_path, sensor_folder_path):
+    """find the optical files and the sensor files covering each of them.
+
+    Returns:
+        (sorted list of optical file names, {optical file name: list of sensor file path})
+    """
     # get the optical data time range and file list
     p = os.path.join(optical_folder_path, "*.csv")
     ls = glob(p)  # path
@@ -310,6 +1126,7 @@ if __name__ == "__main__":
 
     # match optical data with the list of sensor data covering it
     optical_time_list = []  # [start, end] list, day_hour+minute
+    optical_epoch_list = []  # [start, end] list, epoch of the sensor stream
     i = 1
     for op in optical_file_list:
         if i % 20 == 0:
@@ -319,11 +1136,36 @@ if __name__ == "__main__":
         p1 = os.path.join(optical_folder_path, op + '.csv')
         df = pd.read_csv(p1)
         # Access a specific value using row and column index
-        end_epoch = df.iloc[-1, 1] + 18000  # last row, timestamp, (+5h)
+        end_epoch = df.iloc[-1, 1] + OPTICAL_TIME_OFFSET  # last row, timestamp, (+5h)
         end_file = time.strftime('%Y%m%d_%H%M', time.localtime(end_epoch))
         optical_time_list.append([op, end_file])  # ["20250123_1519", "20250123_1525"]
+        optical_epoch_list.append([df.iloc[0, 1] + OPTICAL_TIME_OFFSET, end_epoch])
     print("* End time of all optical files extracted.")
 
+    # with an index.json (written by stream.py) in every sensor folder we need, match on the exact
+    # time range of each sensor file
+    # the last minute of a day is saved in the first file of the next day's folder, which may not exist yet
+    next_days = set(time.strftime("%Y%m%d", time.localtime(time.mktime(time.strptime(end_file[:8], "%Y%m%d"))
+                                                           + 86400 + 3600))
+                    for op, end_file in optical_time_list)
+    days = set(date_range + [end_file[:8] for op, end_file in optical_time_list])
+    days = sorted(days | set(day for day in next_days
+                             if os.path.isdir(os.path.join(sensor_folder_path, "Sensors_" + day))))
+    indexes = [load_sensor_index(os.path.join(sensor_folder_path, "Sensors_" + day)) for day in days]
+    if all(index is not None for index in indexes):
+        print("* match with sensor index of: %s" % ", ".join(days))
+        sensor_ranges = []  # [first, last, path]
+        for day, index in zip(days, indexes):
+            for name, entry in index.items():
+                if entry["rows"]:
+                    sensor_ranges.append([entry["first"], entry["last"],
+                                          os.path.join(sensor_folder_path, "Sensors_" + day, name)])
+        sensor_ranges.sort()
+        matchDict = {}
+        for op, (start_epoch, end_epoch) in zip(optical_file_list, optical_epoch_list):
+            matchDict[op] = [p for first, last, p in sensor_ranges if last >= start_epoch and first <= end_epoch]
+        return optical_file_list, matchDict
+
     sensor_folder_list = []
     for day in date_range:
         sensor_folder_list.append("Sensors_" + day)
@@ -362,10 +1204,230 @@ if __name__ == "__main__":
                 break
     # print(matchDict)
 
+    return optical_file_list, matchDict
+
+
+def task_cost(op, sensor_data_list):
+    """estimated cost of converting an optical file, from the sizes of the files it reads.
+
+    Returns:
+        (bytes read, i.e. run time in arbitrary units; estimated peak memory in bytes)
+    """
+    optical_bytes = os.path.getsize(os.path.join(optical_folder_path, op + '.csv'))
+    sensor_bytes = [os.path.getsize(p) for p in sensor_data_list]
+    per_byte = conf.get("memory_per_byte", 10)
+    if chunk_rows:
+        # one chunk of the optical file and one sensor file at a time
+        memory = min(optical_bytes, chunk_rows * bytes_per_row(os.path.join(optical_folder_path, op + '.csv'))) \
+            + max(sensor_bytes, default=0)
+    else:
+        memory = optical_bytes + sum(sensor_bytes)
+    return optical_bytes + sum(sensor_bytes), per_byte * memory
+
+
+def bytes_per_row(path):
+    """average size of a row of a csv file, from its first 64 kB."""
+    with open(path, "rb") as f:
+        sample = f.read(1 << 16)
+    return len(sample) / max(1, sample.count(b"\n"))
+
+
+def schedule(tasks, budget):
+    """order tasks largest first and pick the pool size for a memory budget.
+
+    Args:
+        tasks: list of (optical file name, sensor file list)
+        budget: bytes of estimated memory the running tasks may use together (0: no limit)
+    Returns:
+        (tasks largest first, their estimated memory, number of worker processes)
+    """
+    costs = [task_cost(op, sensor_data_list) if sensor_data_list else (0, 0) for op, sensor_data_list in tasks]
+    order = sorted(range(len(tasks)), key=lambda i: costs[i][0], reverse=True)
+    tasks = [tasks[i] for i in order]
+    memory = [costs[i][1] for i in order]
+    processes = os.cpu_count() or 1
+    if budget and any(memory):
+        # no more workers than tasks that fit in the budget at once
+        smallest = min(m for m in memory if m)
+        processes = max(1, min(processes, int(budget // smallest)))
+    return tasks, memory, processes
+
+
+def imap_bounded(pool, func, tasks, memory, budget, processes):
+    """like pool.imap_unordered, but only start a task while the estimated memory of the running
+    tasks stays within budget. Tasks are started in the given order, skipping those that do not fit
+    yet; a task larger than the whole budget runs alone.
+
+    Args:
+        pool, func, tasks: as for pool.imap_unordered
+        memory: estimated memory of each task, see schedule
+        budget: bytes (0: no limit, same as pool.imap_unordered)
+        processes: number of workers of the pool
+    """
+    if not budget:
+        yield from pool.imap_unordered(func, tasks)
+        return
+    done = queue.Queue()
+    todo = list(range(len(tasks)))
+    running = {}  # {task index: estimated memory}
+    while todo or running:
+        used = sum(running.values())
+        for i in list(todo):
+            if len(running) >= processes:
+                break
+            if not running or used + memory[i] <= budget:
+                todo.remove(i)
+                running[i] = memory[i]
+                used += memory[i]
+                pool.apply_async(func, (tasks[i],),
+                                 callback=lambda result, i=i: done.put((i, result, None)),
+                                 error_callback=lambda e, i=i: done.put((i, None, e)))
+        i, result, error = done.get()
+        del running[i]
+        if error is not None:
+            raise error
+        yield result
+
+
+def imap_ordered_bounded(pool, func, tasks, memory, budget, processes):
+    """like pool.imap, results in the order of tasks, but a task is only started while the estimated
+    memory of the tasks started and not yet yielded (running, or done and waiting for an earlier one)
+    stays within budget, and while fewer than 2 x processes are in flight; a task larger than the whole
+    budget runs alone.
+
+    Args:
+        pool, func, tasks: as for pool.imap
+        memory: estimated memory of each task
+        budget: bytes (0: no limit but the number of tasks in flight)
+        processes: number of workers of the pool
+    """
+    pending = deque()  # (AsyncResult, estimated memory), in task order
+    used = 0
+    for task, m in zip(tasks, memory):
+        while pending and (len(pending) >= 2 * processes or (budget and used + m > budget)):
+            result, done = pending.popleft()
+            used -= done
+            yield result.get()
+        pending.append((pool.apply_async(func, (task,)), m))
+        used += m
+    while pending:
+        yield pending.popleft()[0].get()
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    init_worker()
+    optical_file_list, matchDict = match_sensor_files(optical_folder_path, sensor_folder_path)
+
     # create h5
-    print("Multiprocessing Pool start:")
-    with multiprocessing.Pool() as pool:  # (processes=4)
-        pool.starmap(work_log, [(d, matchDict) for d in optical_file_list])
+    # start_method: fork (Linux default), spawn or forkserver
+    ctx = multiprocessing.get_context(conf.get("start_method"))
+    if ctx.get_start_method() == "forkserver" and conf.get("preload", True):
+        ctx.set_forkserver_preload(PRELOAD_MODULES)
+
+    # staging: workers write to local scratch, the uploader copies finished files to output_folder
+    uploader = None
+    if write_folder != output_folder:
+        os.makedirs(write_folder, exist_ok=True)
+        uploader = Uploader(conf.get("upload_workers", 4), conf.get("upload_batch", 8),
+                            conf.get("upload_retries", 5))
+
+    def upload(name, callback=None):
+        uploader.submit(os.path.join(write_folder, name), os.path.join(output_folder, name), callback)
+
+    # largest files first, as many at once as the memory budget allows
+    budget = conf.get("memory_budget_mb", 0) * 1e6
+    tasks, memory, processes = schedule([(op, matchDict[op]) for op in optical_file_list], budget)
+
+    # circles reused from file to file are chosen here, in file-name order, whatever the order of conversion;
+    # the files are fitted by a first pool, before the workers that convert them get the circles
+    if cal_file is None and conf.get("circle_reuse_drift", 0):
+        with ctx.Pool(processes, initializer=init_worker, initargs=(conf,)) as pool:
+            circles = plan_circles(pool, [op for op, sensor_data_list in tasks if sensor_data_list],
+                                   conf["circle_reuse_drift"],
+                                   os.path.join(work.path, "circle_fits") if work is not None else None)
+
+    print("Multiprocessing Pool start: %s workers" % processes)
+
+    with ctx.Pool(processes, initializer=init_worker, initargs=(conf, circles)) as pool:
+        if conf.get("output_mode", "file") == "day":
+            # one h5 file per day, written by this process only
+            if work is not None:
+                raise SystemExit("output_mode 'day' cannot be used with work_dir")
+            results = ((op, spectrumDict) for op, status, spectrumDict in
+                       imap_bounded(pool, build_task, tasks, memory, budget, processes) if spectrumDict is not None)
+            written = write_consolidated(results, write_folder, compression, sparse,
+                                         output_folder if uploader is not None else None)
+            print("... %s optical files written to per-day h5 files" % len(written))
+            for op in written:
+                export_log(os.path.join(write_folder, op[:8] + ".h5"), op, "/file_" + op)
+            if uploader is not None:
+                for day in sorted(set(op[:8] for op in written)):
+                    upload(day + ".h5")
+        elif work is None:
+            # optical files larger than split_mb first, one at a time, each split across all workers
+            split_bytes = conf.get("split_mb", 0) * 1e6
+            large = [i for i, (op, sensor_data_list) in enumerate(tasks) if split_bytes and sensor_data_list
+                     and os.path.getsize(os.path.join(optical_folder_path, op + '.csv')) > split_bytes]
+            i = 0
+            for i, k in enumerate(large, 1):
+                op, sensor_data_list = tasks[k]
+                if work_log_split(pool, op, sensor_data_list, split_bytes, budget, processes) == "ok" \
+                        and uploader is not None:
+                    upload(op + ".h5")
+                print("... %s (large) optical files processed" % i)
+            rest = [k for k in range(len(tasks)) if k not in set(large)]
+            for i, (op, status) in enumerate(imap_bounded(pool, work_log_star, [tasks[k] for k in rest],
+                                                          [memory[k] for k in rest], budget, processes), i + 1):
+                if uploader is not None and status == "ok":
+                    upload(op + ".h5")
+                if i % 20 == 0:
+                    print("... %s optical files processed" % i)
+        else:
+            # distributed: other machines work on the same list, each file goes to whoever claims it
+            print("* distributed merge, work folder: %s" % work.path)
+            n = 0
+            renewers = []  # leases of converted files waiting for their upload
+            while True:
+                pending = set(work.pending(optical_file_list))
+                if not pending:
+                    break
+                todo = [i for i, task in enumerate(tasks) if task[0] in pending]
+                claimed = 0
+                for op, status, seconds in imap_bounded(pool, work_log_claimed, [tasks[i] for i in todo],
+                                                        [memory[i] for i in todo], budget, processes):
+                    if status is not None:
+                        if uploader is not None and status == "ok":
+                            # the file may wait in an upload batch for longer than lease_time: keep its
+                            # lease until it is uploaded and marked done
+                            renewer = LeaseRenewer(work, op)
+                            renewer.start()
+
+                            def uploaded(dest, op=op, seconds=seconds, renewer=renewer):
+                                renewer.stop()
+                                work.done(op, "ok", seconds)
+                            upload(op + ".h5", uploaded)
+                            renewers.append(renewer)
+                        claimed += 1
+                        n += 1
+                        if n % 20 == 0:
+                            print("... %s optical files processed on this machine" % n)
+                if uploader is not None:
+                    uploader.wait()
+                    # uploads that failed: let their leases expire, another machine converts them again
+                    for renewer in renewers:
+                        renewer.stop()
+                    renewers = []
+                if not claimed:
+                    # the rest is leased by other machines: wait for them, or for their leases to expire
+                    time.sleep(work.lease_time / 4.0)
+            summary = work.write_summary(optical_file_list)
+            print("* %s optical files processed on this machine, folder summary: %s" % (n, summary["status"]))
+
+    if uploader is not None:
+        failed = uploader.close()
+        for local_path, dest_path in failed:
+            print("! upload failed, file kept in scratch: %s" % local_path)
 
     t = time.time() - t0
     print("* Merge finished! took %.2f min " % (t/60))
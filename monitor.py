@@ -0,0 +1,203 @@
+# live view of the sensor stream, runs next to stream.py (a second subscriber to the same broadcast)
+#
+# $ python monitor.py                                   # last 10 min of a few columns
+# $ python monitor.py --span 3600 -c CavityPressure CavityTemp
+#
+# The Listener thread of the main process only writes each value into a ring buffer in shared
+# memory; a separate drawing process reads the buffers, reduces every column to min/max per screen
+# bin and redraws the lines with blitting. Drawing never holds up the Listener, and the cost of a
+# redraw depends on the number of bins, not on the time span shown.
+
+import argparse
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from Listener_py3 import Listener
+from stream import BROADCAST_PORT_SENSORSTREAM, SensorEntryType, sensorNumberDict
+from utility import header, unixTime, load_conf
+
+DEFAULT_COLUMNS = ["CavityPressure", "CavityTemp", "WarmBoxTemp", "EtalonTemp"]
+
+
+class RingBuffers(object):
+    """Fixed-size ring buffer of (time, value) per sensor column, in shared memory.
+
+    Only one process writes. counts[i] is the number of values ever written to column i and is
+    updated after the value, so a reader never sees a slot before it is filled; the oldest slots may
+    be overwritten while they are copied, which costs a reader at most a few points at the far end.
+    """
+    def __init__(self, n_columns, capacity, name=None):
+        """
+        Args:
+            n_columns: number of columns, index as in utility.header
+            capacity: values kept per column
+            name: name of the shared memory block to attach to (None: create a new one)
+        """
+        self.n_columns = n_columns
+        self.capacity = capacity
+        size = 8 * n_columns + (8 + 4) * n_columns * capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self.counts = np.ndarray((n_columns,), np.int64, buf, 0)
+        offset = 8 * n_columns
+        self.times = np.ndarray((n_columns, capacity), np.float64, buf, offset)
+        offset += 8 * n_columns * capacity
+        self.values = np.ndarray((n_columns, capacity), np.float32, buf, offset)
+        if name is None:
+            self.counts[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, column, t, value):
+        n = self.counts[column]
+        pos = n % self.capacity
+        self.times[column, pos] = t
+        self.values[column, pos] = value
+        self.counts[column] = n + 1
+
+    def read(self, column, t_start):
+        """(times, values) of a column since t_start, oldest first."""
+        n = int(self.counts[column])
+        k = min(n, self.capacity)
+        pos = n % self.capacity
+        idx = np.arange(pos - k, pos) % self.capacity
+        t = self.times[column, idx]
+        v = self.values[column, idx]
+        i0 = np.searchsorted(t, t_start)
+        return t[i0:], v[i0:]
+
+    def latest(self, column):
+        """time of the newest value of a column, None if it has none yet."""
+        n = int(self.counts[column])
+        return self.times[column, (n - 1) % self.capacity] if n else None
+
+    def close(self, unlink=False):
+        del self.counts, self.times, self.values
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def minmax_decimate(t, v, t_start, t_end, bins):
+    """reduce sorted samples to the min and max of each of bins equal time bins.
+
+    Returns:
+        (x, y) with at most 2 * bins points, min then max of every non-empty bin, which draws the
+        same envelope as all samples
+    """
+    if len(t) <= 2 * bins:
+        return t, v
+    edges = np.searchsorted(t, np.linspace(t_start, t_end, bins + 1)[:-1])
+    edges = np.unique(edges[edges < len(t)])
+    mn = np.minimum.reduceat(v, edges)
+    mx = np.maximum.reduceat(v, edges)
+    x = np.repeat(t[edges], 2)
+    y = np.empty(2 * len(edges), v.dtype)
+    y[0::2] = mn
+    y[1::2] = mx
+    return x, y
+
+
+def draw(name, n_columns, capacity, columns, span, bins, interval):
+    """drawing process: redraw the lines from the shared buffers every interval s until the window closes."""
+    import matplotlib.pyplot as plt
+
+    rings = RingBuffers(n_columns, capacity, name)
+    fig, axes = plt.subplots(len(columns), 1, sharex=True, squeeze=False,
+                             figsize=(10, 2 * len(columns) + 1))
+    axes = axes[:, 0]
+    lines = []
+    for ax, column in zip(axes, columns):
+        ax.set_ylabel(column)
+        ax.set_xlim(-span, 0)
+        line, = ax.plot([], [], lw=1, animated=True)
+        lines.append(line)
+    axes[-1].set_xlabel("s before the newest value")
+    fig.tight_layout()
+    plt.show(block=False)
+
+    indices = [header.index(column) for column in columns]
+    background = None
+    try:
+        while plt.fignum_exists(fig.number):
+            t0 = time.time()
+            # sensor time, the analyzer clock need not agree with this computer
+            now = max([rings.latest(i) or 0.0 for i in indices])
+            redraw = background is None
+            for ax, line, i in zip(axes, lines, indices):
+                t, v = rings.read(i, now - span)
+                x, y = minmax_decimate(t, v, now - span, now, bins)
+                line.set_data(x - now, y)
+                if len(y):
+                    lo, hi = ax.get_ylim()
+                    if y.min() < lo or y.max() > hi:
+                        pad = 0.1 * (y.max() - y.min()) or 1.0
+                        ax.set_ylim(y.min() - pad, y.max() + pad)
+                        redraw = True
+            if redraw:
+                # axes changed: draw the static parts once and keep them as the background
+                fig.canvas.draw()
+                background = fig.canvas.copy_from_bbox(fig.bbox)
+            fig.canvas.restore_region(background)
+            for ax, line in zip(axes, lines):
+                ax.draw_artist(line)
+            fig.canvas.blit(fig.bbox)
+            fig.canvas.flush_events()
+            time.sleep(max(0.0, interval - (time.time() - t0)))
+    except KeyboardInterrupt:
+        pass
+    rings.close()
+
+
+if __name__ == "__main__":
+    conf = load_conf()
+    parser = argparse.ArgumentParser(description="live view of the sensor stream")
+    parser.add_argument("-c", "--columns", nargs="+", default=DEFAULT_COLUMNS, choices=header[1:],
+                        metavar="COLUMN", help="sensor columns to show, names as in the csv files")
+    parser.add_argument("--span", type=float, default=600, help="s of data shown")
+    parser.add_argument("--capacity", type=int, default=1 << 16, help="values kept per column")
+    parser.add_argument("--bins", type=int, default=500, help="min/max bins across the plot")
+    parser.add_argument("--interval", type=float, default=0.5, help="s between redraws")
+    args = parser.parse_args()
+
+    rings = RingBuffers(len(header), args.capacity)
+
+    def to_ring(entry):
+        i = sensorNumberDict.get(entry.streamNum)
+        if i:
+            rings.write(i, unixTime(entry.timestamp), entry.value)
+        return None  # nothing to queue
+
+    listener = Listener(
+        queue=None,
+        host=conf["analyzerIP"],
+        port=BROADCAST_PORT_SENSORSTREAM,
+        elementType=SensorEntryType,
+        streamFilter=to_ring,
+        retry=True,
+        name="Sensor stream monitor",
+        socketOptions=conf.get("zmq_socket_options"),
+        reconnectDelay=conf.get("reconnect_delay", 1.0),
+        reconnectDelayMax=conf.get("reconnect_delay_max", 30.0),
+    )
+    drawer = multiprocessing.Process(target=draw, name="monitor drawing",
+                                     args=(rings.name, len(header), args.capacity, args.columns,
+                                           args.span, args.bins, args.interval))
+    drawer.start()
+    try:
+        print("monitoring sensor stream, close the window or press ctrl+C to quit...")
+        while drawer.is_alive():
+            drawer.join(1.0)
+    except KeyboardInterrupt:
+        drawer.terminate()
+    finally:
+        listener.stop()
+        rings.close(unlink=True)
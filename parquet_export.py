@@ -0,0 +1,111 @@
+# Parquet copy of the RDF files written by merge.py, for pandas, pyarrow and DuckDB
+#
+# <parquet_folder>/<table>/day=YYYYMMDD/<optical file>.parquet, one file per optical file and table,
+# with the columns and types of the RDF table (constant columns of sparse files included), in the
+# column order of rdf_reader. Files are zstd compressed with dictionary encoding and min/max
+# statistics per row group, so a query on timestamp skips the row groups and files outside its range:
+#
+# $ duckdb -c "SELECT avg(uncorrectedAbsorbance) FROM read_parquet('<parquet_folder>/rdData/*/*.parquet',
+#              hive_partitioning=true) WHERE day = 20250123 AND timestamp BETWEEN ... AND ..."
+# df = read_parquet_table(parquet_folder, "rdData", columns=[...], filters=[("timestamp", ">=", t)])
+#
+# Tables are copied row_group_rows rows at a time, so an export holds one row group in memory, not
+# the file. pyarrow is only imported when a file is exported or read.
+
+import os
+
+from tables import open_file
+
+from rdf_reader import RdfTable, _hdf5_lock
+
+PARQUET_TABLES = ["rdData", "controlData", "sensorData", "spectrumIndex"]
+ROW_GROUP_ROWS = 65536  # rows per row group: the step of predicate pushdown on timestamp
+
+
+def export_parquet(path, parquet_folder, name, where="/", level=3, row_group_rows=ROW_GROUP_ROWS):
+    """write the tables of an RDF file as Parquet files.
+
+    Each table is read and written one row group at a time. Every file is written to a temporary name
+    and renamed, so a reader never sees a partial file.
+
+    Args:
+        path: RDF h5 file
+        parquet_folder: root folder of the dataset
+        name: optical file name (YYYYMMDD_HHMM), names the files and their day partition
+        where: group holding the tables, e.g. "/file_<name>" in a per-day file
+        level: zstd compression level
+        row_group_rows: rows per row group
+    Returns:
+        list of the Parquet files written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    written = []
+    with _hdf5_lock:
+        h = open_file(path, "r")
+    try:
+        for tableName in PARQUET_TABLES:
+            with _hdf5_lock:
+                if where.rstrip("/") + "/" + tableName not in h:  # e.g. no spectrumIndex in older files
+                    continue
+                table = RdfTable(h, tableName, where)
+            folder = os.path.join(parquet_folder, tableName, "day=" + name[:8])
+            os.makedirs(folder, exist_ok=True)
+            p = os.path.join(folder, name + ".parquet")
+            temp = p + ".tmp"
+            writer = None
+            try:
+                # an empty table still gets a file, with its schema
+                for start in range(0, max(table.nrows, 1), row_group_rows):
+                    with _hdf5_lock:
+                        rows = table.read(start, start + row_group_rows)
+                    part = pa.table(dict((c, rows[c]) for c in rows.dtype.names))
+                    if writer is None:
+                        writer = pq.ParquetWriter(temp, part.schema, compression="zstd", compression_level=level,
+                                                  use_dictionary=True, write_statistics=True)
+                    writer.write_table(part, row_group_size=row_group_rows)
+            finally:
+                if writer is not None:
+                    writer.close()
+            os.replace(temp, p)
+            written.append(p)
+    finally:
+        with _hdf5_lock:
+            h.close()
+    return written
+
+
+def read_parquet_table(parquet_folder, tableName, columns=None, filters=None):
+    """read one table of the Parquet dataset as a DataFrame, every day partition at once.
+
+    Args:
+        parquet_folder: root folder of the dataset
+        tableName: one of PARQUET_TABLES
+        columns: columns to read (default: all)
+        filters: pyarrow filters, e.g. [("timestamp", ">=", t0), ("day", "=", 20250123)]; row groups and
+            files whose statistics or partition cannot match are not read
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(os.path.join(parquet_folder, tableName), columns=columns, filters=filters,
+                          partitioning="hive")
+    return table.to_pandas()
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+
+    parser = argparse.ArgumentParser(description="export RDF files written by merge.py to a Parquet dataset")
+    parser.add_argument("rdf_folder", help="folder of RDF h5 files (one per optical file)")
+    parser.add_argument("parquet_folder", help="root folder of the Parquet dataset")
+    parser.add_argument("--level", type=int, default=3, help="zstd compression level")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.rdf_folder, "*_*.h5")))
+    for i, p in enumerate(paths, 1):
+        export_parquet(p, args.parquet_folder, os.path.basename(p)[:-3], level=args.level)
+        if i % 20 == 0:
+            print("... %s files exported" % i)
+    print("* %s files exported to %s" % (len(paths), args.parquet_folder))
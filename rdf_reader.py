@@ -0,0 +1,163 @@
+# read RDF h5 files written by merge.py
+#
+# data = read_rdf(path, "rdData", columns=["waveNumber", "uncorrectedAbsorbance"], rows=slice(0, 10000))
+# for path, data in iter_rdf(output_folder, "rdData", columns=["waveNumber"]):  # one file at a time
+#     ...
+
+import glob
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tables import open_file
+
+CONSTANT_GROUP = "constantColumns"  # see merge.RdfWriter
+
+# the HDF5 library is not thread safe: prefetch threads take turns
+_hdf5_lock = threading.Lock()
+
+
+class RdfTable(object):
+    """Column access to one table of an RDF file, with constant columns expanded on demand.
+
+    Files written with sparse_columns store the constant columns of a table once, in
+    /constantColumns/<tableName>. RdfTable gives the same view as a table holding every column of
+    the template: col(name) reads a stored column from the file, or builds the constant column only
+    when it is asked for.
+    """
+    def __init__(self, hdf5Handle, tableName, where="/"):
+        where = where.rstrip("/")
+        self.table = hdf5Handle.get_node(where + "/" + tableName)
+        self.constants = {}
+        constantPath = where + "/" + CONSTANT_GROUP + "/" + tableName
+        if constantPath in hdf5Handle:
+            row = hdf5Handle.get_node(constantPath).read()
+            for name in row.dtype.names:
+                self.constants[name] = row[name][0]
+
+    @property
+    def colnames(self):
+        return sorted(list(self.table.colnames) + list(self.constants))
+
+    @property
+    def nrows(self):
+        return self.table.nrows
+
+    def __len__(self):
+        return self.table.nrows
+
+    def col(self, name, start=None, stop=None, step=None):
+        """read one column, optionally a slice of its rows, as a numpy array."""
+        if name in self.constants:
+            nrows = len(range(*slice(start, stop, step).indices(self.table.nrows)))
+            return np.full(nrows, self.constants[name])
+        return self.table.read(start, stop, step, field=name)
+
+    def read(self, start=None, stop=None, step=None):
+        """read rows of every column of the template into a structured array."""
+        stored = self.table.read(start, stop, step)
+        names = self.colnames
+        dtype = [(name, stored.dtype[name] if name in stored.dtype.names else np.asarray(self.constants[name]).dtype)
+                 for name in names]
+        out = np.empty(len(stored), dtype=dtype)
+        for name in names:
+            out[name] = stored[name] if name in stored.dtype.names else self.constants[name]
+        return out
+
+
+def read_rdf_table(path, tableName):
+    """read a whole table of an RDF file, constant columns included, into a structured array."""
+    with _hdf5_lock, open_file(path, "r") as h:
+        return RdfTable(h, tableName).read()
+
+
+def read_rdf(path, tables=None, columns=None, rows=None, where="/"):
+    """read selected columns and rows of an RDF file, without reading the other columns.
+
+    Args:
+        path: RDF h5 file
+        tables: table name, or list of table names (default: every table in where)
+        columns: column names to read from each table (default: all); names a table does not have are skipped
+        rows: slice of rows to read, e.g. slice(0, 1000) (default: all)
+        where: group holding the tables, e.g. "/file_20250123_1519" in a per-day file
+    Returns:
+        {column: numpy array} for one table name, {table: {column: numpy array}} for a list
+    """
+    with _hdf5_lock, open_file(path, "r") as h:
+        if tables is None:
+            names = [t.name for t in h.list_nodes(where, "Table")]
+        else:
+            names = [tables] if isinstance(tables, str) else tables
+        out = dict((name, _read_columns(h, name, columns, rows, where)) for name in names)
+    return out[tables] if isinstance(tables, str) else out
+
+
+def _read_columns(h, tableName, columns=None, rows=None, where="/"):
+    if rows is None:
+        rows = slice(None)
+    table = RdfTable(h, tableName, where)
+    cols = table.colnames if columns is None else [c for c in columns if c in table.colnames]
+    return dict((c, table.col(c, rows.start, rows.stop, rows.step)) for c in cols)
+
+
+def read_spectrum(path, k, columns=None, sensor_columns=None, where="/"):
+    """read spectrum k of an RDF file (0: the first one) through its spectrumIndex table.
+
+    Args:
+        path: RDF h5 file written with a spectrumIndex table
+        k: spectrum number, negative counts from the end
+        columns: rdData columns to read (default: all)
+        sensor_columns: sensorData columns to read (default: all, []: none)
+        where: group holding the tables, see read_rdf
+    Returns:
+        {"rdData": {column: numpy array}, "sensorData": {column: numpy array}}, the rdData rows of the
+        spectrum and the sensor rows recorded while it was measured
+    """
+    with _hdf5_lock, open_file(path, "r") as h:
+        index = RdfTable(h, "spectrumIndex", where).read(k, k + 1 if k != -1 else None)
+        if not len(index):
+            raise IndexError("spectrum %s out of range" % k)
+        index = index[0]
+        return {
+            "rdData": _read_columns(h, "rdData", columns, slice(index["startRow"], index["endRow"]), where),
+            "sensorData": _read_columns(h, "sensorData", sensor_columns,
+                                        slice(index["sensorStartRow"], index["sensorEndRow"]), where),
+        }
+
+
+def iter_rdf(paths, tables=None, columns=None, rows=None, where="/", prefetch=2):
+    """read RDF files one after the other, see read_rdf, reading the next files in the background.
+
+    While the caller works on a file, the next prefetch files are read or waiting; asking for the next
+    file starts one more read before the caller drops the current one, so at most prefetch + 2 files
+    are held in memory. prefetch=0 reads each file only when it is asked for (one file in memory).
+
+    Args:
+        paths: list of RDF files, or a folder (every *.h5 file in it, in name order)
+        prefetch: number of files read ahead by a background thread
+    Yields:
+        (path, data) with data as returned by read_rdf
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(os.path.join(paths, "*.h5")))
+    if not prefetch:
+        for p in paths:
+            yield p, read_rdf(p, tables, columns, rows, where)
+        return
+    # one thread: reads are serialized by the HDF5 lock anyway, it overlaps them with the caller's work
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="rdf prefetch") as executor:
+        pending = deque()
+        todo = iter(paths)
+        while True:
+            # the file just yielded is still held by the caller: prefetch files ahead of it, plus the next one
+            while len(pending) <= prefetch:
+                p = next(todo, None)
+                if p is None:
+                    break
+                pending.append((p, executor.submit(read_rdf, p, tables, columns, rows, where)))
+            if not pending:
+                return
+            p, future = pending.popleft()
+            yield p, future.result()
@@ -0,0 +1,134 @@
+# sensor recording formats besides the wide csv of stream.py, chosen with record_modes in config.yaml
+#
+# "rate": one table per rate group of streams, Sensors_YYYYMMDD/rate_<group>/YYYYMMDD_HHMM.csv, with a
+#         row per timestamp of that group only, so the 1/5 s streams do not add rows of 0 to the
+#         5/s ones. A stream missing at a timestamp is NaN, a real 0 stays 0.
+# "long": every sample as (timestamp, streamNum, value), Sensors_YYYYMMDD/long/YYYYMMDD_HHMM.npz with
+#         one compressed array per field; nothing is padded and sub-second timestamps are kept as they
+#         are. Each distinct timestamp is stored once ("time") with its number of samples ("count").
+
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from utility import header
+
+# columns of utility.header by the rate of their streams, see sensorNumberDict in stream.py
+RATE_GROUPS = {
+    "fast": header[1:21],
+    "slow": header[21:],
+}
+LONG_FOLDER = "long"
+LONG_DTYPE = [("timestamp", np.float64), ("streamNum", np.uint16), ("value", np.float32)]
+
+
+class RateTables(object):
+    """Dense table per rate group, rows started by a new timestamp of the group, NaN where missing."""
+    def __init__(self, groups=RATE_GROUPS):
+        self.groups = groups
+        self.where = {}  # {column index in header: (group, position in its row)}
+        for group, names in groups.items():
+            for i, name in enumerate(names):
+                self.where[header.index(name)] = (group, i + 1)
+        self.rows = dict((g, []) for g in groups)
+        self.current = dict((g, None) for g in groups)  # row still being filled
+
+    def add(self, utime, column, value, stream_num=None):
+        group, i = self.where[column]
+        row = self.current[group]
+        if row is None or row[0] != utime:
+            if row is not None:
+                self.rows[group].append(row)
+            row = [utime] + [math.nan] * len(self.groups[group])
+            self.current[group] = row
+        row[i] = value
+
+    def save(self, folders, day_folder, f1, keep_time=None):
+        """save the rows of every group as f1 in each folder.
+
+        Args:
+            folders: root folders holding the Sensors_YYYYMMDD folders, e.g. local and r-drive
+            day_folder, f1: names of the day folder and of the csv file
+            keep_time: timestamp still being received, its rows are kept for the next file
+        Returns:
+            list of the folders that could not be written
+        """
+        for group, row in self.current.items():
+            if row is not None and row[0] != keep_time:
+                self.rows[group].append(row)
+                self.current[group] = None
+        failed = []
+        for group, rows in self.rows.items():
+            if not rows:
+                continue
+            df = pd.DataFrame(rows, columns=["timestamp"] + self.groups[group])
+            for folder in folders:
+                try:
+                    p = os.path.join(folder, day_folder, "rate_" + group)
+                    os.makedirs(p, exist_ok=True)
+                    df.to_csv(os.path.join(p, f1), index=False, na_rep="NaN")
+                except OSError:
+                    if folder not in failed:
+                        failed.append(folder)
+            self.rows[group] = []
+        return failed
+
+
+class LongRecords(object):
+    """Every sample as (timestamp, streamNum, value), saved column by column."""
+    def __init__(self):
+        self.timestamp = []
+        self.stream_num = []
+        self.value = []
+
+    def add(self, utime, column, value, stream_num=None):
+        self.timestamp.append(utime)
+        self.stream_num.append(stream_num)
+        self.value.append(value)
+
+    def save(self, folders, day_folder, f1, keep_time=None):
+        """save the samples as f1 (.npz) in each folder, see RateTables.save."""
+        n = len(self.timestamp)
+        while n and self.timestamp[n - 1] == keep_time:
+            n -= 1
+        failed = []
+        if not n:
+            return failed
+        timestamp = np.array(self.timestamp[:n], np.float64)
+        # samples arrive grouped by timestamp: one time and a run length per group
+        starts = np.flatnonzero(np.r_[True, timestamp[1:] != timestamp[:-1]])
+        arrays = dict(time=timestamp[starts],
+                      count=np.diff(np.r_[starts, n]).astype(np.uint32),
+                      streamNum=np.array(self.stream_num[:n], np.uint16),
+                      value=np.array(self.value[:n], np.float32))
+        for folder in folders:
+            try:
+                p = os.path.join(folder, day_folder, LONG_FOLDER)
+                os.makedirs(p, exist_ok=True)
+                np.savez_compressed(os.path.join(p, f1[:-4] + ".npz"), **arrays)
+            except OSError:
+                failed.append(folder)
+        del self.timestamp[:n], self.stream_num[:n], self.value[:n]
+        return failed
+
+
+def load_long(path):
+    """samples of a long format file as a structured array with the fields of LONG_DTYPE."""
+    with np.load(path) as z:
+        if "time" in z:
+            timestamp = np.repeat(z["time"], z["count"])
+        else:  # files saved with a timestamp per sample
+            timestamp = z["timestamp"]
+        out = np.empty(len(timestamp), dtype=LONG_DTYPE)
+        out["timestamp"] = timestamp
+        out["streamNum"] = z["streamNum"]
+        out["value"] = z["value"]
+    return out
+
+
+RECORDERS = {
+    "rate": RateTables,
+    "long": LongRecords,
+}
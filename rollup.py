@@ -0,0 +1,116 @@
+# downsampled sensor data (mean/min/max per 10 s, 1 min and 1 h), computed by stream.py as data arrive
+#
+# Saved next to the raw files: Sensors_YYYYMMDD/rollup/10s.csv, 60s.csv and 3600s.csv, one row per
+# interval with the columns timestamp (start of the interval), count and <column>_mean,
+# <column>_min, <column>_max for every sensor column of utility.header.
+# Read them with sensor_store.SensorStore.query_rollup.
+
+import math
+import os
+import time
+
+import pandas as pd
+
+from utility import header
+
+RESOLUTIONS = [10, 60, 3600]  # s
+ROLLUP_FOLDER = "rollup"
+
+
+def rollup_columns():
+    columns = ["timestamp", "count"]
+    for name in header[1:]:
+        columns += [name + "_mean", name + "_min", name + "_max"]
+    return columns
+
+
+class Rollup(object):
+    """mean/min/max of every sensor column per time interval, updated one sample at a time.
+
+    add() costs a few list operations per resolution, whatever the interval. An interval is
+    closed when the first sample of a later interval arrives; closed rows wait in self.closed
+    until take() hands them to write_rollups.
+    """
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = resolutions
+        n = len(header)
+        self.n = n
+        self.start = dict((res, None) for res in resolutions)  # start of the open interval
+        self.count = dict((res, [0] * n) for res in resolutions)
+        self.sum = dict((res, [0.0] * n) for res in resolutions)
+        self.min = dict((res, [math.inf] * n) for res in resolutions)
+        self.max = dict((res, [-math.inf] * n) for res in resolutions)
+        self.closed = dict((res, []) for res in resolutions)
+
+    def add(self, utime, column, value):
+        """add one sample of the sensor column with index column in header (1...)."""
+        for res in self.resolutions:
+            start = utime - utime % res
+            if self.start[res] is None:
+                self.start[res] = start
+            elif start > self.start[res]:
+                self._close(res)
+                self.start[res] = start
+            # a sample slightly out of order goes to the open interval
+            self.count[res][column] += 1
+            self.sum[res][column] += value
+            if value < self.min[res][column]:
+                self.min[res][column] = value
+            if value > self.max[res][column]:
+                self.max[res][column] = value
+
+    def _close(self, res):
+        count, total, mn, mx = self.count[res], self.sum[res], self.min[res], self.max[res]
+        row = [self.start[res], sum(count)]
+        for i in range(1, self.n):
+            if count[i]:
+                row += [total[i] / count[i], mn[i], mx[i]]
+            else:
+                row += [math.nan, math.nan, math.nan]
+        self.closed[res].append(row)
+        n = self.n
+        self.count[res] = [0] * n
+        self.sum[res] = [0.0] * n
+        self.min[res] = [math.inf] * n
+        self.max[res] = [-math.inf] * n
+
+    def close_all(self):
+        """close the open intervals, e.g. when recording stops."""
+        for res in self.resolutions:
+            if self.start[res] is not None and any(self.count[res]):
+                self._close(res)
+
+    def take(self):
+        """{resolution: closed rows} and forget them."""
+        closed = self.closed
+        self.closed = dict((res, []) for res in self.resolutions)
+        return closed
+
+
+def write_rollups(closed, folders):
+    """append closed rows (from Rollup.take) to the rollup files of their day in every folder.
+
+    Args:
+        closed: {resolution: rows}
+        folders: root folders holding the Sensors_YYYYMMDD folders, e.g. local and r-drive
+    Returns:
+        list of the folders that could not be written
+    """
+    failed = []
+    columns = rollup_columns()
+    for res, rows in closed.items():
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(time.strftime("%Y%m%d", time.localtime(row[0])), []).append(row)
+        for day, day_rows in by_day.items():
+            df = pd.DataFrame(day_rows, columns=columns)
+            for folder in folders:
+                try:
+                    p = os.path.join(folder, "Sensors_" + day, ROLLUP_FOLDER)
+                    os.makedirs(p, exist_ok=True)
+                    p = os.path.join(p, "%ss.csv" % res)
+                    df.to_csv(p, mode="a", index=False, header=not os.path.exists(p))
+                except OSError:
+                    if folder not in failed:
+                        failed.append(folder)
+    return failed
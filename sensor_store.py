@@ -0,0 +1,223 @@
+# time range queries over the sensor csv files written by stream.py
+#
+# from sensor_store import SensorStore
+# store = SensorStore(conf["sensor_folder_path"], cache_folder="/home/picarro/sensor_cache")
+# data = store.query(t0, t1, columns=["CavityPressure", "CavityTemp"])  # {column: numpy array}
+
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utility import header, load_sensor_index
+from rollup import RESOLUTIONS, ROLLUP_FOLDER
+
+
+class SensorStore(object):
+    """Read sensor data by time range from the Sensors_YYYYMMDD folders.
+
+    Every csv file is decoded once into a numpy structured array with one float64 field per
+    column. Decoded files are kept in an LRU cache in memory and, with cache_folder, saved as .npy
+    files that are memory-mapped on the next use, so repeated reads do not parse text again.
+    """
+    def __init__(self, folder, cache_folder=None, cache_size=64, save_interval=60):
+        """
+        Args:
+            folder: sensor_folder_path, holding the Sensors_YYYYMMDD folders
+            cache_folder: local folder for the decoded .npy files (None: decode csv files every time
+                they drop out of the memory cache)
+            cache_size: number of decoded files kept in memory
+            save_interval: s, interval of the csv files, used to pick files by name when a day
+                folder has no index.json
+        """
+        self.folder = folder
+        self.cache_folder = cache_folder
+        self.cache_size = cache_size
+        self.save_interval = save_interval
+        self.cache = OrderedDict()  # {path: structured array}
+        self.rollup_cache = {}  # {path: (mtime, structured array)}, rollup files grow during the day
+
+    def files(self, t_start, t_end):
+        """paths of the csv files that may hold data between t_start and t_end (epoch seconds)."""
+        paths = []
+        day = time.mktime(time.strptime(time.strftime("%Y%m%d", time.localtime(t_start)), "%Y%m%d"))
+        # a file holds the data before the time it is saved: the last minute of a day is in the first
+        # file of the next day's folder
+        while day <= t_end + 86400:
+            name = "Sensors_" + time.strftime("%Y%m%d", time.localtime(day))
+            day_folder = os.path.join(self.folder, name)
+            index = load_sensor_index(day_folder)
+            if index is not None:
+                for f in sorted(index):
+                    entry = index[f]
+                    if entry["rows"] and entry["last"] >= t_start and entry["first"] <= t_end:
+                        paths.append(os.path.join(day_folder, f))
+            elif os.path.isdir(day_folder):
+                # a file saved at time T holds the data of about save_interval before T
+                for f in sorted(os.listdir(day_folder)):
+                    try:
+                        t = time.mktime(time.strptime(f[:-4], "%Y%m%d_%H%M"))
+                    except ValueError:
+                        continue
+                    if t_start <= t + 60 and t - 2 * self.save_interval <= t_end:
+                        paths.append(os.path.join(day_folder, f))
+            day += 86400
+        return paths
+
+    def load(self, path):
+        """decoded content of one csv file, as a structured array with a float64 field per column."""
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            return self.cache[path]
+        data = None
+        npy = None
+        if self.cache_folder is not None:
+            day_folder = os.path.basename(os.path.dirname(path))
+            npy = os.path.join(self.cache_folder, day_folder, os.path.basename(path)[:-4] + ".npy")
+            try:
+                if os.path.getmtime(npy) >= os.path.getmtime(path):
+                    data = np.load(npy, mmap_mode="r")
+            except (OSError, ValueError):
+                pass  # not cached yet, or removed meanwhile: decode the csv
+        if data is None:
+            df = pd.read_csv(path, dtype=np.float64)
+            data = df.to_records(index=False)
+            data = data.view(data.dtype, np.ndarray)
+            if npy is not None:
+                os.makedirs(os.path.dirname(npy), exist_ok=True)
+                # pool workers may decode the same file at once: each writes its own temporary file
+                temp = "%s.%s.tmp.npy" % (npy[:-4], os.getpid())
+                try:
+                    np.save(temp, data)
+                    os.replace(temp, npy)
+                except OSError:
+                    # cache folder unusable (e.g. removed meanwhile): keep the decoded array
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                else:
+                    try:
+                        data = np.load(npy, mmap_mode="r")
+                    except (OSError, ValueError):
+                        pass  # keep the decoded array
+        self.cache[path] = data
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return data
+
+    def read_files(self, paths, columns=None):
+        """all rows of the given csv files, {column: numpy array}; missing columns are filled with 0."""
+        if columns is None:
+            columns = header
+        return _stack([self.load(p) for p in paths], columns)
+
+    def query(self, t_start, t_end, columns=None):
+        """sensor data with t_start <= timestamp <= t_end (epoch seconds).
+
+        Args:
+            t_start, t_end: time range, epoch seconds of the sensor stream
+            columns: names of the columns to return (default: every column of utility.header);
+                timestamp is always returned
+        Returns:
+            {column: numpy array}, sorted by timestamp
+        """
+        if columns is None:
+            columns = header
+        columns = ["timestamp"] + [c for c in columns if c != "timestamp"]
+        parts = []
+        for p in self.files(t_start, t_end):
+            d = self.load(p)
+            ts = d["timestamp"]
+            # rows of a file are in time order
+            i0, i1 = np.searchsorted(ts, t_start, "left"), np.searchsorted(ts, t_end, "right")
+            if i1 > i0:
+                parts.append(d[i0:i1])
+        return _stack(parts, columns)
+
+    def query_rollup(self, t_start, t_end, columns=None, resolution=None, max_points=None):
+        """mean/min/max of sensor columns from the coarsest rollup that is fine enough.
+
+        Args:
+            t_start, t_end: time range, epoch seconds of the sensor stream
+            columns: sensor column names (default: every column of utility.header)
+            resolution: s, the coarsest interval that is acceptable
+            max_points: alternatively, the largest number of points wanted between t_start and t_end
+        Returns:
+            (resolution used in s, {"timestamp": ..., "<column>_mean"/"_min"/"_max": ...}); resolution 0
+            means no rollup is fine enough and the raw data were read. Days without a rollup file (recorded
+            before rollups, or whose rollup could not be saved) are rolled up from their raw data.
+        """
+        if columns is None:
+            columns = header[1:]
+        columns = [c for c in columns if c != "timestamp"]
+        if resolution is None:
+            resolution = (t_end - t_start) / max_points if max_points else RESOLUTIONS[0]
+        usable = [res for res in RESOLUTIONS if res <= resolution]
+        if not usable:
+            raw = self.query(t_start, t_end, columns)
+            out = {"timestamp": raw["timestamp"]}
+            for c in columns:
+                out[c + "_mean"] = out[c + "_min"] = out[c + "_max"] = raw[c]
+            return 0, out
+        res = usable[-1]
+        names = ["timestamp"] + [c + s for c in columns for s in ("_mean", "_min", "_max")]
+        days = sorted(set(time.strftime("%Y%m%d", time.localtime(t))
+                          for t in list(np.arange(t_start, t_end, 86400)) + [t_end]))
+        parts = []
+        for day in days:
+            p = os.path.join(self.folder, "Sensors_" + day, ROLLUP_FOLDER, "%ss.csv" % res)
+            if not os.path.exists(p):
+                day_start = time.mktime(time.strptime(day, "%Y%m%d"))
+                day_end = time.mktime(time.strptime(time.strftime("%Y%m%d", time.localtime(day_start + 90000)),
+                                                    "%Y%m%d"))
+                # whole intervals, as in a rollup file, of this day only
+                q0 = max(day_start, t_start - t_start % res)
+                q1 = min(day_end, t_end - t_end % res + res) - 1e-6
+                raw = self.query(q0, q1, columns)
+                parts.append(_rollup_raw(raw, columns, res))
+                continue
+            mtime = os.path.getmtime(p)
+            if p not in self.rollup_cache or self.rollup_cache[p][0] != mtime:
+                d = pd.read_csv(p, dtype=np.float64).to_records(index=False)
+                self.rollup_cache[p] = (mtime, d.view(d.dtype, np.ndarray))
+            d = self.rollup_cache[p][1]
+            ts = d["timestamp"]
+            parts.append(d[(ts + res > t_start) & (ts <= t_end)])
+        return res, _stack(parts, names)
+
+
+def _rollup_raw(raw, columns, res):
+    """rollup rows (timestamp, <column>_mean/_min/_max) of raw data at resolution res, as a structured array.
+
+    A 0 in the wide csv files is a stream without a value at that time, so zeros are left out, as
+    samples that were never received are in the rollups of stream.py; an interval without values is NaN.
+    """
+    ts = raw["timestamp"]
+    starts, inverse = np.unique(ts - ts % res, return_inverse=True)
+    arrays = [starts]
+    for c in columns:
+        v = raw[c]
+        ok = v != 0
+        count = np.bincount(inverse[ok], minlength=len(starts))
+        total = np.bincount(inverse[ok], v[ok], minlength=len(starts))
+        mn = np.full(len(starts), np.inf)
+        mx = np.full(len(starts), -np.inf)
+        np.minimum.at(mn, inverse[ok], v[ok])
+        np.maximum.at(mx, inverse[ok], v[ok])
+        empty = count == 0
+        mean = total / np.where(empty, 1, count)
+        for a in (mean, mn, mx):
+            a[empty] = np.nan
+        arrays += [mean, mn, mx]
+    names = ["timestamp"] + [c + s for c in columns for s in ("_mean", "_min", "_max")]
+    return np.rec.fromarrays(arrays, names=names).view(np.ndarray)
+
+
+def _stack(parts, columns):
+    """{column: numpy array} of the rows of all parts, 0 where a part has no such column."""
+    out = {}
+    for c in columns:
+        out[c] = np.concatenate([np.asarray(d[c]) if c in d.dtype.names else np.zeros(len(d)) for d in parts]
+                                or [np.zeros(0)])
+    return out
@@ -0,0 +1,95 @@
+# copy finished output files from fast local scratch to the shared drive in the background
+#
+# The merge workers write their h5 files to a local scratch folder and go on with the next optical
+# file; the Uploader copies the finished files to the network drive with a few threads, so the
+# CPU workers never wait on SMB/NFS.
+
+import os
+import shutil
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Uploader(object):
+    """Copy files to the shared drive in batches, in parallel and with retries.
+
+    Every file is copied to <dest>.part and renamed to <dest> once complete, so readers of the
+    shared drive never see a partial file. The scratch copy is removed after a successful upload
+    and kept (and reported by close) if all retries fail.
+    """
+    def __init__(self, workers=4, batch_size=8, retries=5, retry_delay=2.0):
+        """
+        Args:
+            workers: number of batches uploaded at the same time
+            batch_size: number of files handed to an upload thread at once
+            retries: attempts per file before giving up
+            retry_delay: s, wait before the first retry, doubled for each next one
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch = []
+        self.futures = []
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def submit(self, local_path, dest_path, callback=None):
+        """queue a finished file; callback(dest_path) is called from an upload thread once it is in place."""
+        self.batch.append((local_path, dest_path, callback))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """start uploading the files queued so far."""
+        if self.batch:
+            self.futures.append(self.executor.submit(self._upload_batch, self.batch))
+            self.batch = []
+
+    def wait(self):
+        """upload what is queued and wait until every upload started so far is finished."""
+        self.flush()
+        for f in self.futures:
+            f.result()
+        self.futures = []
+
+    def close(self):
+        """upload what is left and wait for all uploads.
+
+        Returns:
+            list of (local path, destination path) that could not be uploaded
+        """
+        self.wait()
+        self.executor.shutdown()
+        return self.failed
+
+    def _upload_batch(self, batch):
+        for local_path, dest_path, callback in batch:
+            if self._upload(local_path, dest_path):
+                if callback is not None:
+                    try:
+                        callback(dest_path)
+                    except Exception:
+                        print(traceback.format_exc())
+            else:
+                with self.lock:
+                    self.failed.append((local_path, dest_path))
+
+    def _upload(self, local_path, dest_path):
+        delay = self.retry_delay
+        part = dest_path + ".part"
+        for attempt in range(self.retries):
+            try:
+                shutil.copyfile(local_path, part)
+                os.replace(part, dest_path)
+                os.remove(local_path)
+                return True
+            except OSError as e:
+                print("! upload of %s failed (%s), attempt %s/%s" % (os.path.basename(dest_path), e,
+                                                                    attempt + 1, self.retries))
+                if attempt + 1 < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+        return False
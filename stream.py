@@ -3,13 +3,15 @@
 
 import os
 import queue
+from glob import glob
+import shutil
 import time
 import pandas as pd
 
 from ctypes import c_ubyte, c_byte, c_uint, c_int, c_ushort, c_short
 from ctypes import c_longlong, c_float, c_double, Structure, Union, sizeof
 
-from Listener_py3 import Listener
+from Listener_py3 import Listener, ReplayListener
 
 # RPC_PORT_DRIVER = 50010
 BROADCAST_PORT_SENSORSTREAM = 40020
@@ -23,6 +25,11 @@ class SensorEntryType(Structure):
     ]
 
 from utility import header, unixTime, load_conf
+from utility import sensor_file_entry, update_sensor_index
+from rollup import Rollup, write_rollups
+from journal import Journal, replay, rows_from_records, write_synced
+from recorders import RECORDERS
+from stream_health import StreamHealth, health_line, write_health
 
 # stream_num, keys used in STREAM_MemberTypeDict
 # 4, 5, 6, 28, 7, 8, 29, 30, 35   # save frequency 5/s
@@ -63,6 +70,47 @@ sensorNumberDict = {
     35: 29,
 }
 COLUMN_NUM = len(sensorNumberDict)  # column number in csv file
+streamNumberDict = dict((v, k) for k, v in sensorNumberDict.items())  # {position: stream_num}
+
+
+def free_csv_name(t, folders):
+    """name YYYYMMDD_HHMM.csv of the minute of t, or of the first minute after it that no file of any of
+    folders (day folders) or of their subfolders (rate_*, long, health) uses yet, so a save never
+    overwrites an earlier one, e.g. the rows recovered from the journal just before."""
+    while True:
+        name = time.strftime("%Y%m%d_%H%M", time.localtime(t))
+        if not any(glob(os.path.join(folder, name + ".*")) or glob(os.path.join(folder, "*", name + ".*"))
+                   for folder in folders):
+            return name + '.csv'
+        t += 60
+
+
+def save_sensor_csv(rows, f1, day_folder, local_folder, sensor_folder, uncopied, uncopied_index):
+    """save rows as csv file f1 in day_folder, locally and on r-drive, and add it to index.json.
+
+    The local file is fsynced before this returns, so the journal can be truncated after it. A file
+    that cannot be saved to r-drive is kept in ../temp and added to uncopied/uncopied_index, to be
+    copied later.
+    """
+    my_df = pd.DataFrame(rows)
+    p = os.path.join(local_folder, day_folder, f1)
+    write_synced(p, lambda f: my_df.to_csv(f, index=False, header=header))
+    # time range, rows and columns of the file, so merge does not need to open it
+    entry = sensor_file_entry(rows, p)
+    update_sensor_index(os.path.join(local_folder, day_folder), f1, entry)
+
+    if sensor_folder == local_folder:
+        return
+    p = os.path.join(sensor_folder, day_folder, f1)
+    try:
+        my_df.to_csv(p, index=False, header=header)
+        update_sensor_index(os.path.join(sensor_folder, day_folder), f1, entry)
+    except:
+        # save locally then move later
+        my_df.to_csv("../temp/" + f1, index=False, header=header)
+        uncopied.append(f1)
+        uncopied_index[f1] = entry
+        print("! save to r-drive failed: %s, will try again later." % f1)
 
 
 if __name__ == "__main__":
@@ -71,39 +119,97 @@ if __name__ == "__main__":
     SENSOR_FOLDER = conf["sensor_folder_path"]
     save_time = conf["save_interval"]  # 60, save csv every 60s
     LOCAL_FOLDER = conf["local_folder_path"]
+    record_modes = conf.get("record_modes", ["wide"])
+
+    # replay: decode a capture file of the broadcast, at replay_speed, into replay_output_folder; file names
+    # and save intervals then follow the time of the data instead of the clock of this computer
+    replay_file = conf.get("replay_file")
+    if replay_file:
+        LOCAL_FOLDER = SENSOR_FOLDER = conf["replay_output_folder"]
+    save_folders = [LOCAL_FOLDER] if SENSOR_FOLDER == LOCAL_FOLDER else [LOCAL_FOLDER, SENSOR_FOLDER]
 
-    t0 = int(time.time())
+    t0 = None if replay_file else int(time.time())
     epoch = 0
     huge_list = []
     sensor = [0] * COLUMN_NUM
-    day_folder = 'Sensors_' + time.strftime("%Y%m%d")
+    day_folder = None if replay_file else 'Sensors_' + time.strftime("%Y%m%d")
 
-    subfolder = os.path.join(SENSOR_FOLDER, day_folder)
-    if not os.path.isdir(subfolder):
-        os.mkdir(subfolder)
+    if day_folder is not None:
+        subfolder = os.path.join(SENSOR_FOLDER, day_folder)
+        if not os.path.isdir(subfolder):
+            os.mkdir(subfolder)
 
-    subfolder = os.path.join(LOCAL_FOLDER, day_folder)
-    if not os.path.isdir(subfolder):
-        os.mkdir(subfolder)
+        subfolder = os.path.join(LOCAL_FOLDER, day_folder)
+        if not os.path.isdir(subfolder):
+            os.mkdir(subfolder)
 
     q = queue.Queue(100)
-    listener = Listener(
-        queue=q,
-        host=analyzerIP,
-        port=BROADCAST_PORT_SENSORSTREAM,
-        elementType=SensorEntryType,
-        retry=True,
-        name="Sensor stream listener",
-    )
+    # drop the streams we do not record in the listener thread, before they are queued
+    allowed = dict(allowField="streamNum", allowValues=[k for k in sensorNumberDict if k != 'timestamp'])
+    if replay_file:
+        listener = ReplayListener(q, replay_file, SensorEntryType, speed=conf.get("replay_speed", 1),
+                                  name="Sensor stream replay", **allowed)
+    else:
+        listener = Listener(
+            queue=q,
+            host=analyzerIP,
+            port=BROADCAST_PORT_SENSORSTREAM,
+            elementType=SensorEntryType,
+            retry=True,
+            name="Sensor stream listener",
+            captureFile=conf.get("capture_file"),  # raw frames, to replay this recording later
+            socketOptions=conf.get("zmq_socket_options"),
+            reconnectDelay=conf.get("reconnect_delay", 1.0),
+            reconnectDelayMax=conf.get("reconnect_delay_max", 30.0),
+            **allowed
+        )
     
+    rollup = Rollup()  # 10 s, 1 min and 1 h mean/min/max, saved with every csv
+    recorders = [RECORDERS[mode]() for mode in record_modes if mode != "wide"]
+    # gaps and silent streams, summarized with every csv
+    health = StreamHealth(conf.get("health_gap_factor", 3.0), conf.get("health_silence_s", 10.0))
+    sensor_records = []  # (utime, column, value) of the row in 'sensor', journaled again after a save
     uncopied = []  # uncopied csv files, try again later
+    uncopied_index = {}  # {uncopied csv file: its entry for index.json on r-drive}
     if not os.path.isdir("../temp"):
         os.mkdir("../temp")
 
+    journal = None
+    if conf.get("journal_file") and not replay_file:
+        # data received but not saved when the last run stopped: save them now, named after their last minute
+        records = replay(conf["journal_file"])
+        if records:
+            last_time = records[-1][0]
+            recovered_folder = 'Sensors_' + time.strftime("%Y%m%d", time.localtime(last_time))
+            for folder in [SENSOR_FOLDER, LOCAL_FOLDER]:
+                if not os.path.isdir(os.path.join(folder, recovered_folder)):
+                    os.mkdir(os.path.join(folder, recovered_folder))
+            f1 = free_csv_name(last_time + 60, [os.path.join(folder, recovered_folder) for folder in save_folders])
+            if "wide" in record_modes:
+                rows = rows_from_records(records, COLUMN_NUM)
+                save_sensor_csv(rows, f1, recovered_folder, LOCAL_FOLDER, SENSOR_FOLDER, uncopied, uncopied_index)
+            for recorder in recorders:
+                for utime, column, value in records:
+                    recorder.add(utime, column, value, streamNumberDict[column])
+                recorder.save(save_folders, recovered_folder, f1)
+            print("* recovered %s values from the journal: %s" % (len(records), f1))
+        journal = Journal(conf["journal_file"], conf.get("journal_commit_ms", 50) / 1000.0)
+        journal.truncate()
+
     try:
         print("start recording sensor data, press ctrl+C to quit...")
         while True:
-            data = q.get(timeout=10)
+            try:
+                data = q.get(timeout=1 if replay_file else 10)
+            except queue.Empty:
+                if not replay_file:
+                    # nothing at all for 10 s: report the streams gone silent and keep waiting
+                    for column, quiet in health.check(time.time()):
+                        print("! %s: no data for %.1f s" % (header[column], quiet))
+                    continue
+                if listener.finished.is_set() and q.empty():
+                    break  # end of the capture
+                continue
             utime = unixTime(data.timestamp)
             stream_num = data.streamNum
             value = data.value
@@ -113,6 +219,9 @@ if __name__ == "__main__":
                 if sensor[0] != 0:
                     huge_list.append(sensor)
                 sensor = [0] * COLUMN_NUM
+                sensor_records = []
+                for column, quiet in health.check(utime):
+                    print("! %s: no data for %.1f s" % (header[column], quiet))
 
             # create huge list
             if not sensor[0]:  # initiate
@@ -120,16 +229,30 @@ if __name__ == "__main__":
                 sensor[0] = epoch
 
             try:
-                sensor[sensorNumberDict[stream_num]] = value
+                column = sensorNumberDict[stream_num]
+                sensor[column] = value
+                rollup.add(utime, column, value)
+                back = health.add(utime, column)
+                if back is not None:
+                    print("* %s: data again after %.1f s" % (header[column], back))
+                if journal is not None:
+                    journal.append(utime, column, value)
+                    sensor_records.append((utime, column, value))
+                for recorder in recorders:
+                    recorder.add(utime, column, value, stream_num)
 
-                t = int(time.time())
+                t = int(utime) if replay_file else int(time.time())
+                if t0 is None:
+                    t0 = t
                 if t - t0 > save_time:
                     # data failed to save to r-drive previously: try again
                     if uncopied:
                         for i in range(len(uncopied)):
                             try:
                                 f0 = uncopied[0]
-                                shutil.copy2("../temp/" + f0, os.path.join(SENSOR_FOLDER, 'Sensors_' + f0[:8], f0))
+                                folder = os.path.join(SENSOR_FOLDER, 'Sensors_' + f0[:8])
+                                shutil.copy2("../temp/" + f0, os.path.join(folder, f0))
+                                update_sensor_index(folder, f0, uncopied_index.pop(f0))
                                 print("* copy to r-drive successful: %s" % f0)
                                 uncopied.pop(0)
                                 os.remove("../temp/" + f0)
@@ -137,29 +260,36 @@ if __name__ == "__main__":
                                 pass
 
                     # create csv
-                    my_df = pd.DataFrame(huge_list)
-
-                    f1 = time.strftime("%Y%m%d_%H%M") + '.csv'
-                    today = 'Sensors_' + time.strftime("%Y%m%d")
+                    today = 'Sensors_' + time.strftime("%Y%m%d", time.localtime(t))
                     if day_folder != today:
                         subfolder = os.path.join(SENSOR_FOLDER, today)
-                        os.mkdir(subfolder)
+                        os.makedirs(subfolder, exist_ok=True)
                         subfolder = os.path.join(LOCAL_FOLDER, today)
-                        os.mkdir(subfolder)
+                        os.makedirs(subfolder, exist_ok=True)
                         day_folder = today
-                        print("a new day just started: ", time.ctime())
-
-                    p = os.path.join(LOCAL_FOLDER, day_folder, f1)
-                    my_df.to_csv(p, index=False, header=header)
-
-                    p = os.path.join(SENSOR_FOLDER, day_folder, f1)
-                    try:
-                        my_df.to_csv(p, index=False, header=header)
-                    except:
-                        # save locally then move later
-                        my_df.to_csv("../temp/" + f1, index=False, header=header)
-                        uncopied.append(f1)
-                        print("! save to r-drive failed: %s, will try again later." % f1)
+                        print("a new day just started: ", time.ctime(t))
+                    f1 = free_csv_name(t, [os.path.join(folder, day_folder) for folder in save_folders])
+
+                    if "wide" in record_modes:
+                        save_sensor_csv(huge_list, f1, day_folder, LOCAL_FOLDER, SENSOR_FOLDER, uncopied,
+                                        uncopied_index)
+                    for recorder in recorders:
+                        for folder in recorder.save(save_folders, day_folder, f1, sensor[0]):
+                            print("! save %s to %s failed." % (type(recorder).__name__, folder))
+                    if journal is not None:
+                        # the saved rows are safe; keep only the row still being filled
+                        journal.truncate()
+                        for record in sensor_records:
+                            journal.append(*record)
+
+                    for folder in write_rollups(rollup.take(), save_folders):
+                        print("! save rollups to %s failed." % folder)
+                    summary = health.take()
+                    line = health_line(summary)
+                    if line is not None:
+                        print("! %s: %s" % (f1, line))
+                    for folder in write_health(summary, save_folders, day_folder, f1):
+                        print("! save health summary to %s failed." % folder)
                     t0 = t
                     huge_list = []
             except:  # skip value not in dictionary keys
@@ -168,6 +298,34 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         pass
 
+    # save what was received since the last csv
+    if sensor[0] != 0:
+        huge_list.append(sensor)
+    if huge_list:
+        t = int(huge_list[-1][0]) if replay_file else int(time.time())
+        if day_folder is None or replay_file:
+            day_folder = 'Sensors_' + time.strftime("%Y%m%d", time.localtime(t))
+            for folder in [SENSOR_FOLDER, LOCAL_FOLDER]:
+                os.makedirs(os.path.join(folder, day_folder), exist_ok=True)
+        f1 = free_csv_name(t, [os.path.join(folder, day_folder) for folder in save_folders])
+        try:
+            if "wide" in record_modes:
+                save_sensor_csv(huge_list, f1, day_folder, LOCAL_FOLDER, SENSOR_FOLDER, uncopied, uncopied_index)
+            for recorder in recorders:
+                recorder.save(save_folders, day_folder, f1)
+            rollup.close_all()
+            write_rollups(rollup.take(), save_folders)
+            write_health(health.take(), save_folders, day_folder, f1)
+            print("* saved %s" % f1)
+            if journal is not None:
+                journal.truncate()
+        except Exception as e:
+            print("! final save failed: %s" % e)
+    if journal is not None:
+        journal.close()
+    if listener.capture is not None:
+        listener.capture.flush()
+
 
 # @author: Yilin Shi | 2025.1.29
 # shiyilin890@gmail.com
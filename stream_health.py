@@ -0,0 +1,178 @@
+# health of the sensor streams, tracked by stream.py as data arrive
+#
+# For every sensor column the time of its last sample and its usual interval (moving average) are
+# kept in fixed-size lists, updated with a few operations per sample. An interval longer than
+# gap_factor usual intervals counts as a gap; a stream without samples for silence s (and at least
+# gap_factor usual intervals) is reported silent until it comes back. A stalled stream then no
+# longer looks like a stream whose value is 0.
+#
+# With every saved csv the summary of the streams over that file is saved too:
+# Sensors_YYYYMMDD/health/YYYYMMDD_HHMM.json, read back for a whole day with load_health.
+
+import json
+import os
+
+import pandas as pd
+
+from utility import header
+
+HEALTH_FOLDER = "health"
+WARMUP = 5  # intervals seen before the usual interval of a stream is trusted
+ALPHA = 0.05  # weight of a new interval in the moving average
+
+
+class StreamHealth(object):
+    """last sample time, usual interval, sample and gap counts of every sensor column."""
+    def __init__(self, gap_factor=3.0, silence=10.0):
+        """
+        Args:
+            gap_factor: an interval this many times the usual interval of its stream is a gap
+            silence: s without a sample before a stream is reported silent
+        """
+        n = len(header)
+        self.n = n
+        self.gap_factor = gap_factor
+        self.silence = silence
+        self.last = [None] * n  # time of the last sample
+        self.interval = [0.0] * n  # usual interval, s
+        self.intervals = [0] * n  # intervals averaged so far
+        self.silent = [False] * n
+        # since the last take()
+        self.samples = [0] * n
+        self.gaps = [0] * n
+        self.gap_time = [0.0] * n  # s missing, beyond the usual interval
+        self.max_gap = [0.0] * n
+        self.start = None
+        self.newest = None
+
+    def add(self, utime, column):
+        """add one sample of the sensor column with index column in header (1...).
+
+        Returns:
+            s the stream was silent for if it was reported silent and is back, else None
+        """
+        self.samples[column] += 1
+        if self.start is None:
+            self.start = utime
+        if self.newest is None or utime > self.newest:
+            self.newest = utime
+        last = self.last[column]
+        self.last[column] = utime
+        if last is None:
+            return None
+        dt = utime - last
+        if dt > 0:
+            usual = self.interval[column]
+            if self.intervals[column] >= WARMUP and dt > self.gap_factor * usual:
+                self.gaps[column] += 1
+                self.gap_time[column] += dt - usual
+                if dt > self.max_gap[column]:
+                    self.max_gap[column] = dt
+            else:
+                self.interval[column] = dt if not self.intervals[column] else usual + ALPHA * (dt - usual)
+                self.intervals[column] += 1
+        if self.silent[column]:
+            self.silent[column] = False
+            return dt
+        return None
+
+    def check(self, now=None):
+        """streams that went silent since the last check.
+
+        Args:
+            now: current time of the data (None: time of the newest sample of any stream)
+        Returns:
+            [(column, s since its last sample), ...]
+        """
+        if now is None:
+            now = self.newest
+        silent = []
+        for column in range(1, self.n):
+            last = self.last[column]
+            if last is None or self.silent[column]:
+                continue
+            quiet = now - last
+            if quiet > self.silence and quiet > self.gap_factor * self.interval[column]:
+                self.silent[column] = True
+                silent.append((column, quiet))
+        return silent
+
+    def take(self):
+        """summary of the streams since the last take, and start counting again.
+
+        Returns:
+            {"start", "end": time of the first and newest sample, "streams": {column name: [samples, rate (/s),
+            usual rate (/s), gaps, s missing in gaps, longest gap (s)]}, "silent": [column names]}
+        """
+        span = (self.newest - self.start) if self.start is not None else 0.0
+        streams = {}
+        for column in range(1, self.n):
+            if self.last[column] is None:
+                continue
+            usual = 1.0 / self.interval[column] if self.interval[column] else 0.0
+            streams[header[column]] = [self.samples[column],
+                                       round(self.samples[column] / span, 3) if span > 0 else 0.0,
+                                       round(usual, 3),
+                                       self.gaps[column],
+                                       round(self.gap_time[column], 3),
+                                       round(self.max_gap[column], 3)]
+        summary = {
+            "start": self.start,
+            "end": self.newest,
+            "streams": streams,
+            "silent": [header[c] for c in range(1, self.n) if self.silent[c]],
+        }
+        self.samples = [0] * self.n
+        self.gaps = [0] * self.n
+        self.gap_time = [0.0] * self.n
+        self.max_gap = [0.0] * self.n
+        self.start = None
+        return summary
+
+
+def health_line(summary):
+    """one line about the gaps and silent streams of a summary, for the console; None if there are none."""
+    bad = ["%s %d gaps %.1f s" % (name, s[3], s[4]) for name, s in summary["streams"].items() if s[3]]
+    if summary["silent"]:
+        bad.append("silent: " + ", ".join(summary["silent"]))
+    return "; ".join(bad) if bad else None
+
+
+def write_health(summary, folders, day_folder, f1):
+    """save a summary as health/<f1 without .csv>.json in day_folder of each folder.
+
+    Returns:
+        list of the folders that could not be written
+    """
+    failed = []
+    for folder in folders:
+        try:
+            p = os.path.join(folder, day_folder, HEALTH_FOLDER)
+            os.makedirs(p, exist_ok=True)
+            with open(os.path.join(p, f1[:-4] + ".json"), "w") as f:
+                json.dump(summary, f, separators=(",", ":"))
+        except OSError:
+            failed.append(folder)
+    return failed
+
+
+def load_health(day_path):
+    """health summaries of a Sensors_YYYYMMDD folder, one row per file and stream.
+
+    Returns:
+        DataFrame with the columns file, start, end, column, samples, rate, usual_rate, gaps, gap_s,
+        max_gap_s and silent
+    """
+    rows = []
+    p = os.path.join(day_path, HEALTH_FOLDER)
+    names = sorted(os.listdir(p)) if os.path.isdir(p) else []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(p, name)) as f:
+            summary = json.load(f)
+        for column, s in summary["streams"].items():
+            rows.append([name[:-5] + ".csv", summary["start"], summary["end"], column] + s
+                        + [column in summary["silent"]])
+    return pd.DataFrame(rows, columns=["file", "start", "end", "column", "samples", "rate", "usual_rate", "gaps",
+                                       "gap_s", "max_gap_s", "silent"])
@@ -1,5 +1,7 @@
 # constants, utility functions
 import datetime
+import json
+import os
 import yaml
 import platform
 
@@ -162,6 +164,13 @@ controlData_key = [
 ]
 
 
+# s, optical file timestamps are 5h behind the sensor stream timestamps
+OPTICAL_TIME_OFFSET = 18000
+
+# per day folder index of the sensor csv files, written by stream.py
+SENSOR_INDEX_FILE = "index.json"
+
+
 ORIGIN = datetime.datetime(datetime.MINYEAR, 1, 1, 0, 0, 0, 0)
 UNIXORIGIN = datetime.datetime(1970, 1, 1, 0, 0, 0, 0)
 
@@ -183,6 +192,52 @@ def load_conf():
     return conf
 
 
+def sensor_file_entry(rows, path):
+    """index entry of a sensor csv file written from rows (lists in the order of header).
+
+    columns is a bit mask over header: bit i is set if column i has any non-zero value.
+    """
+    mask = 0
+    for i in range(len(header)):
+        if any(row[i] for row in rows):
+            mask |= 1 << i
+    return {
+        "first": rows[0][0] if rows else None,
+        "last": rows[-1][0] if rows else None,
+        "rows": len(rows),
+        "columns": mask,
+        "bytes": os.path.getsize(path),
+    }
+
+
+def load_sensor_index(folder):
+    """{csv file name: entry} of a Sensors_YYYYMMDD folder, or None if it has no index."""
+    try:
+        with open(os.path.join(folder, SENSOR_INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def update_sensor_index(folder, filename, entry):
+    """add or replace the entry of one csv file in the index of folder.
+
+    The index is written to a temporary file and renamed, so readers never see a partial index.
+    """
+    index = load_sensor_index(folder) or {}
+    index[filename] = entry
+    p = os.path.join(folder, SENSOR_INDEX_FILE)
+    temp = p + ".tmp"
+    with open(temp, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(temp, p)
+
+
+def index_columns(mask):
+    """names of the columns set in the columns mask of an index entry."""
+    return [name for i, name in enumerate(header) if mask >> i & 1]
+
+
 ################# for reference ####################
 # from Host.autogen interface.py
 STREAM_MemberTypeDict = {}
@@ -0,0 +1,178 @@
+# share merge tasks between several machines through lease files in a shared folder
+#
+# For every task (optical file name) the work folder holds at most:
+#   <task>.lease  the task is being converted by the machine named in the file; the file mtime
+#                 is renewed while it works, a lease not renewed for lease_time is expired
+#   <task>.done   the task is finished, json with the node, status and duration
+# There is no coordinator: a lease is claimed by creating the file with O_EXCL, which only one
+# machine can do, and an expired lease is taken over by renaming it away first, which also only
+# one machine can do. Times are compared with the mtime of a file touched in the same folder, so
+# the clocks of the machines do not need to agree.
+
+import json
+import os
+import socket
+import threading
+import time
+
+CLOCK_FILE = ".clock"
+SUMMARY_FILE = "summary.json"
+
+
+def write_json_atomic(path, obj):
+    """write obj as json to path, readers see either the old or the new file."""
+    temp = "%s.%s.%s.tmp" % (path, socket.gethostname(), os.getpid())
+    with open(temp, "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(temp, path)
+
+
+class WorkDir(object):
+    """Lease files for the tasks of a distributed merge, see the notes at the top of this file."""
+    def __init__(self, path, lease_time=600, node=None):
+        """
+        Args:
+            path: shared work folder, created if needed; use one folder per backfill
+            lease_time: s, a lease that was not renewed for this long is taken over by another node
+            node: name of this machine in the lease and done files, default hostname
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.node = node if node is not None else socket.gethostname()
+        os.makedirs(path, exist_ok=True)
+
+    def _lease(self, task):
+        return os.path.join(self.path, task + ".lease")
+
+    def _done(self, task):
+        return os.path.join(self.path, task + ".done")
+
+    def now(self):
+        """current time of the file server."""
+        p = os.path.join(self.path, CLOCK_FILE)
+        with open(p, "a"):
+            os.utime(p, None)
+        return os.path.getmtime(p)
+
+    def is_done(self, task):
+        return os.path.exists(self._done(task))
+
+    def pending(self, tasks):
+        """tasks that are not done yet, claimed by someone or not."""
+        done = set(f[:-5] for f in os.listdir(self.path) if f.endswith(".done"))
+        return [t for t in tasks if t not in done]
+
+    def claim(self, task):
+        """try to take the task; True if this process now holds its lease."""
+        if self.is_done(task):
+            return False
+        lease = self._lease(task)
+        if self._create(lease):
+            return True
+        # somebody holds the lease; take it over if it expired
+        try:
+            expired = self.now() - os.path.getmtime(lease) > self.lease_time
+        except FileNotFoundError:
+            expired = True
+        if not expired:
+            return False
+        stale = "%s.stale.%s.%s" % (lease, self.node, os.getpid())
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False  # another node took it over first
+        if self.now() - os.path.getmtime(stale) <= self.lease_time:
+            # the lease was renewed or taken over between the check and the rename: give it back
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return self._create(lease) and not self.is_done(task)
+
+    def _create(self, lease):
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"node": self.node, "pid": os.getpid(), "claimed": time.time()}, f)
+        return True
+
+    def renew(self, task):
+        os.utime(self._lease(task), None)
+
+    def release(self, task):
+        try:
+            os.remove(self._lease(task))
+        except FileNotFoundError:
+            pass
+
+    def done(self, task, status, seconds):
+        """mark the task finished (whatever the status, it is not tried again) and drop its lease."""
+        write_json_atomic(self._done(task), {"node": self.node, "status": status,
+                                              "seconds": round(seconds, 3), "finished": time.time()})
+        self.release(task)
+
+    def write_summary(self, tasks):
+        """write summary.json for the whole folder once every task is done.
+
+        Returns:
+            the summary, or None if some tasks are not done yet
+        """
+        if self.pending(tasks):
+            return None
+        status = {}
+        nodes = {}
+        seconds = 0.0
+        for task in tasks:
+            with open(self._done(task)) as f:
+                d = json.load(f)
+            status.setdefault(d["status"], []).append(task)
+            nodes[d["node"]] = nodes.get(d["node"], 0) + 1
+            seconds += d["seconds"]
+        summary = {
+            "tasks": len(tasks),
+            "status": dict((k, len(v)) for k, v in status.items()),
+            "not_ok": dict((k, v) for k, v in status.items() if k != "ok"),
+            "nodes": nodes,
+            "cpu_seconds": round(seconds, 1),
+        }
+        write_json_atomic(os.path.join(self.path, SUMMARY_FILE), summary)
+        return summary
+
+
+class LeaseRenewer(threading.Thread):
+    """Renew the lease of a task in the background while it is being converted.
+
+        with LeaseRenewer(work, task):
+            convert(task)
+    """
+    def __init__(self, work, task, interval=None):
+        threading.Thread.__init__(self, name="lease " + task)
+        self.daemon = True
+        self.work = work
+        self.task = task
+        self.interval = interval if interval is not None else work.lease_time / 4.0
+        self._stopevent = threading.Event()
+
+    def run(self):
+        while not self._stopevent.wait(self.interval):
+            try:
+                self.work.renew(self.task)
+            except OSError:
+                pass  # network hiccup, try again at the next interval
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        self._stopevent.set()
+        if self.ident is not None:  # started
+            self.join()